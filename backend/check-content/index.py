@@ -1,7 +1,614 @@
 import json
+import math
 import os
+import re
+import time
+import hashlib
+import threading
 import urllib.request
 import urllib.error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Пакетный режим (texts: [...])
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '100'))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '6'))
+# Короткие тексты (pack=true) анализируются по несколько в одном запросе
+PACK_MAX_CHARS = 600
+PACK_GROUP_SIZE = 8
+
+# Кэш результатов Gemini: sha256(версия промпта + нормализованный текст) -> анализ.
+# LRU в памяти тёплого контейнера + таблица quality_cache в Postgres (если задан DATABASE_URL)
+QUALITY_CACHE_TTL_SEC = int(os.environ.get('QUALITY_CACHE_TTL_SEC', str(30 * 24 * 3600)))
+QUALITY_CACHE_LRU_SIZE = int(os.environ.get('QUALITY_CACHE_LRU_SIZE', '1024'))
+ANALYSIS_PROMPT_VERSION = 'check-content:v2'
+# Оценки из пакетного запроса грубее одиночных - у них своё пространство ключей
+PACKED_PROMPT_VERSION = 'check-content-packed:v1'
+_quality_lru = OrderedDict()
+_quality_lock = threading.Lock()
+_db_lock = threading.Lock()
+_db_conn = None
+
+# Структурированные ответы Gemini: счётчики разбора по endpoint (ok/recovered/failed)
+_parse_stats = {}
+_parse_lock = threading.Lock()
+
+ANALYSIS_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'ai_score': {'type': 'INTEGER'},
+        'uniqueness_score': {'type': 'INTEGER'},
+        'ai_indicators': {'type': 'ARRAY', 'items': {'type': 'STRING'}},
+        'improvement_tips': {'type': 'ARRAY', 'items': {'type': 'STRING'}}
+    },
+    'required': ['ai_score', 'uniqueness_score', 'ai_indicators', 'improvement_tips'],
+    'propertyOrdering': ['ai_score', 'uniqueness_score', 'ai_indicators', 'improvement_tips']
+}
+
+PACKED_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {'index': {'type': 'INTEGER'}, **ANALYSIS_SCHEMA['properties']},
+        'required': ['index'] + ANALYSIS_SCHEMA['required'],
+        'propertyOrdering': ['index'] + ANALYSIS_SCHEMA['propertyOrdering']
+    }
+}
+
+# Map-reduce для длинных текстов: куски с перекрытием анализируются параллельно
+CHUNK_CHARS = int(os.environ.get('CHUNK_CHARS', '3000'))
+CHUNK_OVERLAP = 300
+CHUNK_MAX = int(os.environ.get('CHUNK_MAX', '8'))
+
+# Локальная предоценка: если оценка вне полосы [LOW, HIGH], анализ через Gemini не нужен
+PRESCORE_LOW = int(os.environ.get('PRESCORE_LOW', '15'))
+PRESCORE_HIGH = int(os.environ.get('PRESCORE_HIGH', '85'))
+# Короче этого признаки ненадёжны - всегда спрашиваем Gemini
+PRESCORE_MIN_WORDS = 80
+_prescore_stats = {'checked': 0, 'skipped': 0}
+_prescore_lock = threading.Lock()
+
+# Типичные штампы сгенерированного текста. ai_phrases.json - копия doc-writer/ai_phrases.json
+# (функции деплоятся отдельными каталогами): меняйте оба файла вместе, иначе оценки разойдутся
+AI_PHRASES_PATH = os.environ.get('AI_PHRASES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai_phrases.json'))
+
+def compile_stock_phrases(path: str):
+    '''Одно регулярное выражение по фразам из JSON; ",?" внутри фразы - необязательная запятая'''
+    with open(path, encoding='utf-8') as f:
+        phrases = sorted(json.load(f), key=len, reverse=True)
+    alternatives = [re.escape(phrase.lower()).replace(',\\?', ',?') for phrase in phrases]
+    return re.compile(r'\b(?:' + '|'.join(alternatives) + r')\b', re.IGNORECASE)
+
+_STOCK_PHRASES_RE = compile_stock_phrases(AI_PHRASES_PATH)
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])\s+')
+_WORD_RE = re.compile(r'\w+')
+_PUNCTUATION = '.,;:!?—–-…()"«»\''
+
+def _clamp01(value: float) -> float:
+    return max(0.0, min(1.0, value))
+
+def estimate_ai_score(text: str) -> dict:
+    '''Быстрая локальная оценка "похожести на ИИ" по стилометрическим признакам, без вызова модели'''
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return {'ai_score': 50, 'uniqueness_score': 50, 'words': 0, 'features': {}}
+
+    # Плотность штампов на 100 слов
+    stock_density = len(_STOCK_PHRASES_RE.findall(text)) * 100 / len(words)
+
+    # Разброс длины предложений: у модели предложения однообразнее
+    lengths = [len(_WORD_RE.findall(sentence)) for sentence in _SENTENCE_SPLIT_RE.split(text.strip())]
+    lengths = [n for n in lengths if n]
+    mean = sum(lengths) / len(lengths)
+    sentence_cv = math.sqrt(sum((n - mean) ** 2 for n in lengths) / len(lengths)) / mean
+
+    # Доля уникальных слов на фиксированном окне, чтобы не зависеть от длины текста
+    window = words[:300]
+    type_token_ratio = len(set(window)) / len(window)
+
+    # Энтропия знаков препинания: у человека они разнообразнее
+    counts = {}
+    for ch in text:
+        if ch in _PUNCTUATION:
+            counts[ch] = counts.get(ch, 0) + 1
+    total = sum(counts.values())
+    punctuation_entropy = -sum(c / total * math.log2(c / total) for c in counts.values()) if total else 0.0
+
+    stock_term = _clamp01(stock_density / 2.0)
+    variance_term = _clamp01((0.6 - sentence_cv) / 0.4)
+    ttr_term = _clamp01((0.75 - type_token_ratio) / 0.25)
+    punctuation_term = _clamp01((1.8 - punctuation_entropy) / 1.3)
+
+    return {
+        'ai_score': round(100 * (0.4 * stock_term + 0.25 * variance_term + 0.15 * ttr_term + 0.2 * punctuation_term)),
+        'uniqueness_score': round(100 * (1 - (0.6 * stock_term + 0.4 * ttr_term))),
+        'words': len(words),
+        'features': {
+            'stock_per_100_words': round(stock_density, 2),
+            'sentence_length_cv': round(sentence_cv, 3),
+            'type_token_ratio': round(type_token_ratio, 3),
+            'punctuation_entropy': round(punctuation_entropy, 3)
+        }
+    }
+
+def local_analysis(local: dict) -> dict:
+    '''Признаки и советы для ответа по локальной оценке (в формате анализа Gemini)'''
+    features = local['features']
+    indicators = []
+    tips = []
+    if features['stock_per_100_words'] >= 1:
+        indicators.append(f"Много шаблонных фраз ({features['stock_per_100_words']} на 100 слов)")
+        tips.append('Замените штампы вроде "важно отметить", "является", "в рамках" на простые слова')
+    if features['sentence_length_cv'] < 0.35:
+        indicators.append('Однообразная длина предложений')
+        tips.append('Чередуйте короткие и длинные предложения')
+    if features['type_token_ratio'] < 0.5:
+        indicators.append('Бедный словарь, много повторов')
+        tips.append('Используйте синонимы и конкретные примеры')
+    if features['punctuation_entropy'] < 1.0:
+        indicators.append('Однообразная пунктуация')
+        tips.append('Добавьте вопросы, восклицания, тире и цитаты')
+    return {
+        'ai_score': local['ai_score'],
+        'uniqueness_score': local['uniqueness_score'],
+        'ai_indicators': indicators,
+        'improvement_tips': tips
+    }
+
+def prescore_stats() -> dict:
+    '''Сколько проверок закрыто локальной оценкой без вызова Gemini'''
+    with _prescore_lock:
+        stats = dict(_prescore_stats)
+    checked = stats['checked']
+    return {**stats, 'skip_rate': round(stats['skipped'] / checked, 3) if checked else 0.0}
+
+def build_analysis_prompt(text: str) -> str:
+    '''Промпт для анализа одного текста'''
+    return f"""Проанализируй следующий текст по двум критериям:
+
+ТЕКСТ:
+{text}
+
+ЗАДАЧИ:
+1. AI-детекция: Оцени от 0 до 100, насколько текст похож на сгенерированный ИИ
+   - Признаки AI: повторяющиеся фразы, шаблонность, искусственная структура, клише
+   - Признаки человека: естественность, эмоции, неидеальность, личный стиль
+
+2. Уникальность формулировок: Оцени от 0 до 100, насколько оригинальны формулировки
+   - Низкая (0-40): Много общих/шаблонных фраз и конструкций
+   - Средняя (40-70): Есть уникальные формулировки, но много стандартных
+   - Высокая (70-100): Оригинальный стиль, свежие формулировки
+
+ВЕРНИ СТРОГО JSON:
+{{
+  "ai_score": <число 0-100>,
+  "uniqueness_score": <число 0-100>,
+  "ai_indicators": ["признак 1", "признак 2"],
+  "improvement_tips": ["совет 1", "совет 2"]
+}}
+
+ВАЖНО: Отвечай ТОЛЬКО JSON, без текста до и после!"""
+
+def extract_json(text: str):
+    '''Достаёт JSON из ответа модели: целиком, из ```-обёртки или первый сбалансированный объект/массив.
+    ValueError - JSON не найден'''
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start = next((i for i, ch in enumerate(text) if ch in '{['), -1)
+    while start >= 0:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in '{[':
+                depth += 1
+            elif ch in '}]':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        return json.loads(text[start:i + 1])
+                    except ValueError:
+                        break
+        # Скобка не открыла валидный JSON - ищем следующую
+        start = next((i for i in range(start + 1, len(text)) if text[i] in '{['), -1)
+    raise ValueError('JSON не найден в ответе модели')
+
+_SCHEMA_TYPES = {
+    'OBJECT': dict, 'ARRAY': list, 'STRING': str,
+    'INTEGER': (int, float), 'NUMBER': (int, float), 'BOOLEAN': bool
+}
+
+def validate_schema(value, schema: dict, path: str = '$'):
+    '''Проверяет значение по responseSchema (типы и required). ValueError - не совпало'''
+    expected = _SCHEMA_TYPES.get(schema.get('type'))
+    if expected and (not isinstance(value, expected) or (expected != bool and isinstance(value, bool))):
+        raise ValueError(f'{path}: ожидался {schema["type"]}')
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                raise ValueError(f'{path}: нет поля {key}')
+        for key, sub in schema.get('properties', {}).items():
+            if key in value:
+                validate_schema(value[key], sub, f'{path}.{key}')
+    elif isinstance(value, list) and 'items' in schema:
+        for i, item in enumerate(value):
+            validate_schema(item, schema['items'], f'{path}[{i}]')
+
+def parse_structured(text: str, schema: dict, endpoint: str):
+    '''Разбирает структурированный ответ и сверяет со схемой, считая исходы по endpoint.
+    ValueError - ответ не разобрался даже толерантным извлечением'''
+    outcome = 'ok'
+    try:
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = extract_json(text)
+            outcome = 'recovered'
+        validate_schema(value, schema)
+    except ValueError:
+        outcome = 'failed'
+        raise
+    finally:
+        with _parse_lock:
+            stats = _parse_stats.setdefault(endpoint, {'ok': 0, 'recovered': 0, 'failed': 0})
+            stats[outcome] += 1
+    return value
+
+def parse_stats() -> dict:
+    '''Исходы разбора структурированных ответов по endpoint'''
+    with _parse_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _parse_stats.items()}
+
+def call_gemini(prompt: str, api_key: str, proxy_url: str = None, schema: dict = None, endpoint: str = 'analyze'):
+    '''Один запрос к Gemini с JSON-ответом по schema (responseSchema).
+    Возвращает разобранный и проверенный JSON или None; ValueError - ответ не разобрался'''
+    gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
+    
+    gemini_request = {
+        'contents': [{
+            'parts': [{'text': prompt}]
+        }],
+        'generationConfig': {
+            'responseMimeType': 'application/json',
+            'responseSchema': schema or ANALYSIS_SCHEMA
+        }
+    }
+    
+    req = urllib.request.Request(
+        gemini_url,
+        data=json.dumps(gemini_request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    
+    with urllib.request.urlopen(req, timeout=30) as response:
+        gemini_response = json.loads(response.read().decode('utf-8'))
+    
+    if 'candidates' not in gemini_response or not gemini_response['candidates']:
+        return None
+    
+    result_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
+    return parse_structured(result_text, schema or ANALYSIS_SCHEMA, endpoint)
+
+def split_text_chunks(text: str, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> list:
+    '''Режет текст на куски до size символов с перекрытием overlap, по границе слова'''
+    if len(text) <= size:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind(' ', start + size // 2, end)
+            end = cut if cut > 0 else end
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Перекрытие начинаем с целого слова
+        space = text.find(' ', start, end)
+        start = space + 1 if space >= 0 else start
+    return chunks
+
+def _merge_unique(lists: list) -> list:
+    '''Объединяет списки строк без повторов (без учёта регистра), сохраняя порядок'''
+    seen = set()
+    merged = []
+    for items in lists:
+        for item in items or []:
+            key = ' '.join(str(item).lower().split())
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(item)
+    return merged
+
+def combine_chunk_analyses(scored: list) -> dict:
+    '''Сводит анализы кусков [(кусок, анализ)]: оценки - среднее с весом по длине'''
+    total = sum(len(chunk) for chunk, _ in scored)
+    return {
+        'ai_score': round(sum(a.get('ai_score', 50) * len(c) for c, a in scored) / total),
+        'uniqueness_score': round(sum(a.get('uniqueness_score', 50) * len(c) for c, a in scored) / total),
+        'ai_indicators': _merge_unique([a.get('ai_indicators') for _, a in scored]),
+        'improvement_tips': _merge_unique([a.get('improvement_tips') for _, a in scored])
+    }
+
+def analyze_long(text: str, api_key: str, proxy_url: str = None) -> dict:
+    '''Анализ через Gemini; длинный текст - по кускам параллельно (время ~ как у одного куска).
+    Для нескольких кусков в результат добавляется chunks с оценками по кускам'''
+    chunks = split_text_chunks(text)
+    if len(chunks) > CHUNK_MAX:
+        chunks = split_text_chunks(text, math.ceil(len(text) / CHUNK_MAX) + CHUNK_OVERLAP)
+    
+    def run(chunk: str) -> dict:
+        analysis = call_gemini(build_analysis_prompt(chunk), api_key, proxy_url)
+        if analysis is None:
+            raise Exception('Не удалось получить анализ текста')
+        return analysis
+    
+    if len(chunks) == 1:
+        return make_result(run(chunks[0]), 'gemini')
+    
+    scored = []
+    error = None
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        for chunk, future in zip(chunks, [pool.submit(run, chunk) for chunk in chunks]):
+            try:
+                scored.append((chunk, future.result()))
+            except Exception as e:
+                print(f"Chunk analysis failed: {e}")
+                error = e
+    if not scored:
+        raise error
+    
+    result = make_result(combine_chunk_analyses(scored), 'gemini')
+    result['chunks'] = [
+        {'ai_score': a.get('ai_score', 50), 'uniqueness_score': a.get('uniqueness_score', 50), 'chars': len(c)}
+        for c, a in scored
+    ]
+    if len(scored) < len(chunks):
+        result['partial'] = True
+    return result
+
+def make_result(analysis: dict, source: str) -> dict:
+    '''Ответ проверки в едином формате'''
+    # Определяем, прошел ли текст проверку
+    ai_score = analysis.get('ai_score', 50)
+    uniqueness_score = analysis.get('uniqueness_score', 50)
+    
+    return {
+        'ai_score': ai_score,
+        'uniqueness_score': uniqueness_score,
+        'passed': ai_score < 50 and uniqueness_score > 70,
+        'ai_indicators': analysis.get('ai_indicators', []),
+        'improvement_tips': analysis.get('improvement_tips', []),
+        'source': source
+    }
+
+def prescore_text(text: str, band: tuple = None) -> dict:
+    '''Локальная предоценка: результат, если она уверенная, иначе None'''
+    low, high = band or (PRESCORE_LOW, PRESCORE_HIGH)
+    local = estimate_ai_score(text)
+    confident = local['words'] >= PRESCORE_MIN_WORDS and (local['ai_score'] < low or local['ai_score'] > high)
+    # Тексты пакета оцениваются из разных потоков
+    with _prescore_lock:
+        _prescore_stats['checked'] += 1
+        if confident:
+            _prescore_stats['skipped'] += 1
+    if confident:
+        return make_result(local_analysis(local), 'local')
+    return None
+
+def quality_cache_key(text: str, version: str = ANALYSIS_PROMPT_VERSION) -> str:
+    '''Ключ кэша: версия промпта + текст с нормализованными пробелами'''
+    normalized = ' '.join(text.split())
+    return hashlib.sha256(f'{version}\n{normalized}'.encode('utf-8')).hexdigest()
+
+def _query_cache(sql: str, params: tuple, fetch: bool = False):
+    '''Запрос к quality_cache через переиспользуемое соединение. Без DATABASE_URL - None'''
+    global _db_conn
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return None
+    import psycopg2
+    with _db_lock:
+        for attempt in range(2):
+            try:
+                if _db_conn is None or _db_conn.closed:
+                    _db_conn = psycopg2.connect(dsn)
+                    _db_conn.autocommit = True
+                cur = _db_conn.cursor()
+                cur.execute(sql, params)
+                return cur.fetchone() if fetch else None
+            except psycopg2.OperationalError:
+                # Соединение тёплого контейнера могло умереть - одно переподключение
+                _db_conn = None
+                if attempt:
+                    raise
+
+def _lru_put(key: str, result: dict, created_at: float):
+    with _quality_lock:
+        _quality_lru[key] = (created_at, dict(result))
+        _quality_lru.move_to_end(key)
+        while len(_quality_lru) > QUALITY_CACHE_LRU_SIZE:
+            _quality_lru.popitem(last=False)
+
+def quality_cache_get(text: str, version: str = ANALYSIS_PROMPT_VERSION) -> dict:
+    '''Сохранённый анализ текста с пометкой cached, None - промах'''
+    key = quality_cache_key(text, version)
+    now = time.time()
+    with _quality_lock:
+        entry = _quality_lru.get(key)
+        if entry and now - entry[0] < QUALITY_CACHE_TTL_SEC:
+            _quality_lru.move_to_end(key)
+            return {**entry[1], 'cached': True}
+        if entry:
+            del _quality_lru[key]
+    try:
+        row = _query_cache("""
+            SELECT result, EXTRACT(EPOCH FROM created_at)
+            FROM quality_cache
+            WHERE cache_key = %s AND created_at > NOW() - %s * INTERVAL '1 second'
+        """, (key, QUALITY_CACHE_TTL_SEC), fetch=True)
+    except Exception as e:
+        print(f"Quality cache read failed: {e}")
+        return None
+    if not row:
+        return None
+    result = row[0] if isinstance(row[0], dict) else json.loads(row[0])
+    _lru_put(key, result, float(row[1]))
+    return {**result, 'cached': True}
+
+def quality_cache_put(text: str, result: dict, version: str = ANALYSIS_PROMPT_VERSION):
+    '''Сохраняет анализ в LRU и Postgres, попутно удаляя просроченные записи'''
+    key = quality_cache_key(text, version)
+    _lru_put(key, result, time.time())
+    try:
+        _query_cache("""
+            INSERT INTO quality_cache (cache_key, result, created_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (cache_key) DO UPDATE SET result = EXCLUDED.result, created_at = NOW()
+        """, (key, json.dumps(result, ensure_ascii=False)))
+        _query_cache("DELETE FROM quality_cache WHERE created_at < NOW() - %s * INTERVAL '1 second'", (QUALITY_CACHE_TTL_SEC,))
+    except Exception as e:
+        print(f"Quality cache write failed: {e}")
+
+def analyze_text(text: str, api_key: str, proxy_url: str = None, prescore: bool = True, band: tuple = None, cache: bool = True) -> dict:
+    '''Полный анализ одного текста: кэш, локальная предоценка, при неуверенности - Gemini'''
+    cached = quality_cache_get(text) if cache else None
+    if cached:
+        return cached
+    
+    if prescore:
+        local_result = prescore_text(text, band)
+        if local_result:
+            return local_result
+    
+    result = analyze_long(text, api_key, proxy_url)
+    # Частичный результат (часть кусков упала) не кэшируем
+    if not result.get('partial'):
+        quality_cache_put(text, result)
+    return result
+
+def analyze_packed(texts: list, api_key: str, proxy_url: str = None) -> list:
+    '''Анализ нескольких коротких текстов одним запросом. None - ответ не разобрался.
+    Результат сопоставляется с текстом только по index из ответа: для текста без однозначного index
+    в списке None - его нужно проверить отдельно, а не брать оценку по позиции'''
+    items = '\n\n'.join(f'ТЕКСТ {i + 1}:\n{text}' for i, text in enumerate(texts))
+    prompt = f"""Проанализируй каждый из {len(texts)} текстов по двум критериям:
+1. AI-детекция: от 0 до 100, насколько текст похож на сгенерированный ИИ
+2. Уникальность формулировок: от 0 до 100, насколько оригинальны формулировки
+
+{items}
+
+ВЕРНИ СТРОГО JSON-массив из {len(texts)} объектов в том же порядке:
+[
+  {{
+    "index": <номер текста>,
+    "ai_score": <число 0-100>,
+    "uniqueness_score": <число 0-100>,
+    "ai_indicators": ["признак 1"],
+    "improvement_tips": ["совет 1"]
+  }}
+]
+
+ВАЖНО: Отвечай ТОЛЬКО JSON, без текста до и после!"""
+    try:
+        analyses = call_gemini(prompt, api_key, proxy_url, PACKED_SCHEMA, 'packed')
+    except ValueError:
+        return None
+    if not isinstance(analyses, list):
+        return None
+    by_index = {}
+    duplicated = set()
+    for a in analyses:
+        index = a.get('index') if isinstance(a, dict) else None
+        if index in by_index:
+            duplicated.add(index)
+        by_index[index] = a
+    results = []
+    for i, text in enumerate(texts):
+        analysis = by_index.get(i + 1) if i + 1 not in duplicated else None
+        if analysis is None:
+            results.append(None)
+            continue
+        result = make_result(analysis, 'gemini_packed')
+        quality_cache_put(text, result, PACKED_PROMPT_VERSION)
+        results.append(result)
+    if all(result is None for result in results):
+        return None
+    return results
+
+def analyze_batch(texts: list, api_key: str, proxy_url: str = None, prescore: bool = True, band: tuple = None, pack: bool = False) -> list:
+    '''Анализ списка текстов параллельно (не больше BATCH_MAX_CONCURRENCY запросов).
+    Результаты - в исходном порядке, ошибка одного текста не валит остальные'''
+    results = [None] * len(texts)
+    pending = []
+    for i, text in enumerate(texts):
+        if not isinstance(text, str) or not text.strip():
+            results[i] = {'error': 'Текст не предоставлен'}
+            continue
+        cached = quality_cache_get(text) or (quality_cache_get(text, PACKED_PROMPT_VERSION) if pack else None)
+        if cached:
+            results[i] = cached
+            continue
+        local_result = prescore_text(text, band) if prescore else None
+        if local_result:
+            results[i] = local_result
+        else:
+            pending.append(i)
+    
+    # Группы коротких текстов - один запрос на группу, остальные по одному
+    tasks = []
+    if pack:
+        short = [i for i in pending if len(texts[i]) <= PACK_MAX_CHARS]
+        tasks = [short[k:k + PACK_GROUP_SIZE] for k in range(0, len(short), PACK_GROUP_SIZE)]
+        pending = [i for i in pending if len(texts[i]) > PACK_MAX_CHARS]
+    tasks += [[i] for i in pending]
+    
+    def run(indexes: list):
+        out = []
+        if len(indexes) > 1:
+            try:
+                packed = analyze_packed([texts[i] for i in indexes], api_key, proxy_url)
+            except Exception as e:
+                print(f"Packed analysis failed: {e}")
+                packed = None
+            if packed:
+                out = [(i, result) for i, result in zip(indexes, packed) if result is not None]
+                indexes = [i for i, result in zip(indexes, packed) if result is None]
+                if indexes:
+                    print(f"Packed analysis: {len(indexes)} texts without a matching index, re-checking one by one")
+        # Одиночный текст, группа не разобралась или текст без своего index - по одному
+        for i in indexes:
+            try:
+                out.append((i, analyze_text(texts[i], api_key, proxy_url, prescore=False, cache=False)))
+            except Exception as e:
+                out.append((i, {'error': str(e)}))
+        return out
+    
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_CONCURRENCY, len(tasks))) as pool:
+            for pairs in pool.map(run, tasks):
+                for i, result in pairs:
+                    results[i] = result
+    return results
 
 def handler(event: dict, context) -> dict:
     '''Проверяет текст на AI-паттерны и уникальность через Gemini API'''
@@ -32,8 +639,9 @@ def handler(event: dict, context) -> dict:
     try:
         body = json.loads(event.get('body', '{}'))
         text = body.get('text', '')
+        texts = body.get('texts')
         
-        if not text:
+        if not text and not isinstance(texts, list):
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -41,6 +649,14 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
+        if isinstance(texts, list) and len(texts) > BATCH_MAX_ITEMS:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': f'Не больше {BATCH_MAX_ITEMS} текстов за запрос'}),
+                'isBase64Encoded': False
+            }
+        
         api_key = os.environ.get('GEMINI_API_KEY')
         proxy_url = os.environ.get('PROXY_URL')
         
@@ -52,88 +668,35 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        # Промпт для анализа текста
-        prompt = f"""Проанализируй следующий текст по двум критериям:
-
-ТЕКСТ:
-{text[:3000]}
-
-ЗАДАЧИ:
-1. AI-детекция: Оцени от 0 до 100, насколько текст похож на сгенерированный ИИ
-   - Признаки AI: повторяющиеся фразы, шаблонность, искусственная структура, клише
-   - Признаки человека: естественность, эмоции, неидеальность, личный стиль
-
-2. Уникальность формулировок: Оцени от 0 до 100, насколько оригинальны формулировки
-   - Низкая (0-40): Много общих/шаблонных фраз и конструкций
-   - Средняя (40-70): Есть уникальные формулировки, но много стандартных
-   - Высокая (70-100): Оригинальный стиль, свежие формулировки
-
-ВЕРНИ СТРОГО JSON:
-{{
-  "ai_score": <число 0-100>,
-  "uniqueness_score": <число 0-100>,
-  "ai_indicators": ["признак 1", "признак 2"],
-  "improvement_tips": ["совет 1", "совет 2"]
-}}
-
-ВАЖНО: Отвечай ТОЛЬКО JSON, без текста до и после!"""
-
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        
-        gemini_request = {
-            'contents': [{
-                'parts': [{'text': prompt}]
-            }]
-        }
-        
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
+        prescore = body.get('prescore', True) is not False
+        band = body.get('prescoreBand')
+        band = (band[0], band[1]) if isinstance(band, list) and len(band) == 2 else None
         
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
+        chunk_scores = body.get('chunkScores') is True
         
-        with urllib.request.urlopen(req, timeout=30) as response:
-            gemini_response = json.loads(response.read().decode('utf-8'))
-        
-        if 'candidates' in gemini_response and gemini_response['candidates']:
-            result_text = gemini_response['candidates'][0]['content']['parts'][0]['text'].strip()
-            
-            # Очистка от markdown форматирования
-            if result_text.startswith('```'):
-                lines = result_text.split('\n')
-                result_text = '\n'.join(lines[1:-1]) if len(lines) > 2 else result_text
-                result_text = result_text.replace('```json', '').replace('```', '').strip()
-            
-            analysis = json.loads(result_text)
-            
-            # Определяем, прошел ли текст проверку
-            ai_score = analysis.get('ai_score', 50)
-            uniqueness_score = analysis.get('uniqueness_score', 50)
-            
-            passed = ai_score < 50 and uniqueness_score > 70
-            
+        if isinstance(texts, list):
+            results = analyze_batch(texts, api_key, proxy_url, prescore, band, pack=body.get('pack') is True)
+            if not chunk_scores:
+                results = [{k: v for k, v in r.items() if k != 'chunks'} for r in results]
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                 'body': json.dumps({
-                    'ai_score': ai_score,
-                    'uniqueness_score': uniqueness_score,
-                    'passed': passed,
-                    'ai_indicators': analysis.get('ai_indicators', []),
-                    'improvement_tips': analysis.get('improvement_tips', [])
+                    'results': results,
+                    'errors': sum(1 for r in results if 'error' in r),
+                    'prescore': prescore_stats(),
+                    'parse': parse_stats()
                 }, ensure_ascii=False),
                 'isBase64Encoded': False
             }
         
+        result = analyze_text(text, api_key, proxy_url, prescore, band)
+        if not chunk_scores:
+            result.pop('chunks', None)
         return {
-            'statusCode': 500,
+            'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Не удалось получить анализ текста'}),
+            'body': json.dumps({**result, 'prescore': prescore_stats(), 'parse': parse_stats()}, ensure_ascii=False),
             'isBase64Encoded': False
         }
         
@@ -0,0 +1,111 @@
+"""
+Микро-бенчмарк humanize_text: однопроходный движок против прежней реализации (цикл re.sub по паттернам).
+Прогоняет реалистичные разделы по ~600 слов, проверяет совпадение результата и печатает пропускную способность.
+
+    python backend/doc-writer/bench_humanize.py [--sections 200] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from index import humanize_text  # noqa: E402
+
+def humanize_text_reference(text: str) -> str:
+    '''Прежняя реализация humanize_text - эталон для сравнения'''
+    ai_phrases = {
+        r'\bв современном мире\b': 'сейчас',
+        r'\bв настоящее время\b': 'сегодня',
+        r'\bважно отметить,? что\b': '',
+        r'\bследует отметить,? что\b': '',
+        r'\bнеобходимо подчеркнуть\b': 'стоит сказать',
+        r'\bнемаловажно отметить\b': 'также',
+        r'\bданный\b': 'этот',
+        r'\bданная\b': 'эта',
+        r'\bданное\b': 'это',
+        r'\bданные\b': 'эти',
+        r'\bявляется\b': 'есть',
+        r'\bпредставляет собой\b': 'это',
+        r'\bосуществляется\b': 'происходит',
+        r'\bпозволяет\b': 'дает возможность',
+        r'\bв заключение\b': 'подводя итог',
+        r'\bтаким образом,?\b': 'итак,',
+        r'\bследовательно,?\b': 'значит,',
+        r'\bкак показывает практика\b': 'на практике',
+        r'\bв рамках\b': 'в',
+    }
+
+    result = text
+    for pattern, replacement in ai_phrases.items():
+        result = re.sub(pattern, replacement, result, flags=re.IGNORECASE)
+
+    result = re.sub(r'\s+', ' ', result)
+    result = re.sub(r'\s+([.,;:!?])', r'\1', result)
+
+    return result.strip()
+
+STOCK = [
+    'В современном мире', 'в настоящее время', 'Важно отметить, что', 'следует отметить что',
+    'необходимо подчеркнуть', 'Немаловажно отметить', 'данный', 'Данная', 'данное', 'данные',
+    'является', 'представляет собой', 'осуществляется', 'позволяет', 'В заключение',
+    'Таким образом,', 'следовательно', 'как показывает практика', 'в рамках',
+]
+WORDS = (
+    'технология развитие студент исследование модель процесс результат система анализ пример '
+    'метод задача решение подход практика данных опыт компания рынок обучение эффект '
+    'важный новый сложный простой быстрый точный полезный современный первый основной'
+).split()
+
+def make_section(rng: random.Random, words: int = 600) -> str:
+    '''Собирает раздел ~words слов с типичной для модели плотностью штампов'''
+    out = []
+    count = 0
+    while count < words:
+        sentence = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+        for _ in range(rng.randint(0, 2)):
+            sentence.insert(rng.randrange(len(sentence) + 1), rng.choice(STOCK))
+        count += sum(len(part.split()) for part in sentence)
+        text = ' '.join(sentence)
+        out.append(text[0].upper() + text[1:] + rng.choice(['.', '.', '!', '?', ' .', ' ,  и']))
+        if rng.random() < 0.15:
+            out.append('\n\n')
+    return ' '.join(out)
+
+def bench(fn, sections: list, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for text in sections:
+            fn(text)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sections = [make_section(rng) for _ in range(args.sections)]
+
+    mismatches = sum(1 for text in sections if humanize_text(text) != humanize_text_reference(text))
+    if mismatches:
+        print(f'MISMATCH: {mismatches} of {len(sections)} sections differ')
+        sys.exit(1)
+
+    t_ref = bench(humanize_text_reference, sections, args.repeat)
+    t_new = bench(humanize_text, sections, args.repeat)
+    print(f'sections={len(sections)} x ~600 words, best of {args.repeat}, outputs identical')
+    print(f'reference : {len(sections) / t_ref:9.1f} sections/s')
+    print(f'compiled  : {len(sections) / t_new:9.1f} sections/s  (x{t_ref / t_new:.2f})')
+
+if __name__ == '__main__':
+    main()
@@ -3,52 +3,524 @@ import os
 import urllib.request
 import urllib.error
 import re
+import math
+import time
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import uuid
+import hashlib
+import base64
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-def humanize_text(text: str) -> str:
-    '''Пост-процессинг: заменяет AI-фразы на человечные'''
-    
-    # Словарь замен типичных AI-паттернов
-    ai_phrases = {
-        r'\bв современном мире\b': 'сейчас',
-        r'\bв настоящее время\b': 'сегодня',
-        r'\bважно отметить,? что\b': '',
-        r'\bследует отметить,? что\b': '',
-        r'\bнеобходимо подчеркнуть\b': 'стоит сказать',
-        r'\bнемаловажно отметить\b': 'также',
-        r'\bданный\b': 'этот',
-        r'\bданная\b': 'эта',
-        r'\bданное\b': 'это',
-        r'\bданные\b': 'эти',
-        r'\bявляется\b': 'есть',
-        r'\bпредставляет собой\b': 'это',
-        r'\bосуществляется\b': 'происходит',
-        r'\bпозволяет\b': 'дает возможность',
-        r'\bв заключение\b': 'подводя итог',
-        r'\bтаким образом,?\b': 'итак,',
-        r'\bследовательно,?\b': 'значит,',
-        r'\bкак показывает практика\b': 'на практике',
-        r'\bв рамках\b': 'в',
+# Параллельная генерация разделов задачи (mode == 'run_job')
+SECTION_WORKERS_PER_JOB = int(os.environ.get('SECTION_WORKERS_PER_JOB', '4'))
+SECTION_WORKERS_GLOBAL = int(os.environ.get('SECTION_WORKERS_GLOBAL', '8'))
+# Общий лимит одновременных вызовов Gemini на весь тёплый контейнер
+_gemini_slots = threading.BoundedSemaphore(SECTION_WORKERS_GLOBAL)
+_usage_lock = threading.Lock()
+# Очередь разделов: аренда раздела воркером, после истечения раздел снова доступен другим воркерам
+SECTION_LEASE_SEC = int(os.environ.get('SECTION_LEASE_SEC', '300'))
+SECTION_MAX_ATTEMPTS = int(os.environ.get('SECTION_MAX_ATTEMPTS', '3'))
+# Пауза перед повтором упавшего раздела: SECTION_RETRY_BASE_SEC * 2^(попытка - 1)
+SECTION_RETRY_BASE_SEC = float(os.environ.get('SECTION_RETRY_BASE_SEC', '10'))
+# Воркер продлевает аренду своих разделов, пока они генерируются
+SECTION_LEASE_RENEW_SEC = SECTION_LEASE_SEC / 3
+# После этого воркер не берёт новые разделы и дожидается начатых (должно быть меньше таймаута функции)
+WORKER_MAX_RUN_SEC = int(os.environ.get('WORKER_MAX_RUN_SEC', '240'))
+# Как часто (сек) дописывать накопленные фрагменты потоковой генерации в document_sections.content
+STREAM_FLUSH_SEC = float(os.environ.get('STREAM_FLUSH_SEC', '1.0'))
+# Разделы пишутся с updated_at = clock_timestamp(), но видны читателю только после коммита.
+# get_status с since перечитывает это окно до курсора, чтобы не потерять запись, закоммиченную после опроса
+STATUS_CURSOR_OVERLAP_SEC = int(os.environ.get('STATUS_CURSOR_OVERLAP_SEC', '5'))
+
+# Длинные разделы делятся на части не длиннее SECTION_CHUNK_WORDS слов, части пишутся параллельно
+SECTION_CHUNK_WORDS = 600
+SECTION_MAX_CHUNKS = int(os.environ.get('SECTION_MAX_CHUNKS', '16'))
+
+# Настройки по уровню качества: max_attempts - сколько кандидатов раздела генерировать параллельно
+QUALITY_SETTINGS = {
+    'standard': {'max_attempts': 1, 'ai_threshold': 85, 'uniqueness_threshold': 30},
+    'high': {'max_attempts': 2, 'ai_threshold': 70, 'uniqueness_threshold': 50},
+    'max': {'max_attempts': 3, 'ai_threshold': 60, 'uniqueness_threshold': 60}
+}
+
+# Пул соединений с Postgres живёт между вызовами тёплого контейнера.
+# DATABASE_POOL_URL - адрес локального PgBouncer (или аналога), иначе DATABASE_URL
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+# Сколько соединений открыть сразу при создании пула (остальные - по требованию)
+DB_POOL_WARM = int(os.environ.get('DB_POOL_WARM', '1'))
+# Соединение, простоявшее дольше, перед выдачей проверяется SELECT 1
+DB_HEALTHCHECK_IDLE_SEC = float(os.environ.get('DB_HEALTHCHECK_IDLE_SEC', '30'))
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_stats = {'acquired': 0, 'reused': 0, 'reconnected': 0, 'overflow': 0}
+_db_stats_lock = threading.Lock()
+
+# Кэш структур (mode == 'topics'): LRU в памяти контейнера + таблица outline_cache в Postgres
+OUTLINE_CACHE_TTL_SEC = int(os.environ.get('OUTLINE_CACHE_TTL_SEC', str(7 * 24 * 3600)))
+OUTLINE_CACHE_LRU_SIZE = int(os.environ.get('OUTLINE_CACHE_LRU_SIZE', '256'))
+# Меняется вместе с промптом структуры, чтобы не отдавать результаты старого промпта
+OUTLINE_PROMPT_VERSION = 1
+_outline_lru = OrderedDict()
+_outline_lru_lock = threading.Lock()
+_outline_cache_stats = {'lru_hit': 0, 'db_hit': 0, 'miss': 0, 'bypass': 0}
+
+# Локальная предоценка: если оценка вне полосы [LOW, HIGH], проверка через Gemini не нужна
+PRESCORE_LOW = int(os.environ.get('PRESCORE_LOW', '15'))
+PRESCORE_HIGH = int(os.environ.get('PRESCORE_HIGH', '85'))
+# Короче этого признаки ненадёжны - всегда спрашиваем Gemini
+PRESCORE_MIN_WORDS = 80
+_prescore_stats = {'checked': 0, 'skipped': 0}
+_prescore_lock = threading.Lock()
+
+# Экспорт (mode == 'export'): файл собирается во временном файле (в памяти до порога, дальше на диске).
+# Больше EXPORT_INLINE_MAX_BYTES отдаём ссылкой на S3 - ответ функции ограничен по размеру
+EXPORT_SPOOL_BYTES = 1024 * 1024
+EXPORT_INLINE_MAX_BYTES = int(os.environ.get('EXPORT_INLINE_MAX_BYTES', str(3 * 1024 * 1024)))
+
+# Структурированные ответы Gemini: счётчики разбора по endpoint (ok/recovered/failed)
+_parse_stats = {}
+_parse_lock = threading.Lock()
+
+QUALITY_SCORES_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'ai_score': {'type': 'INTEGER'},
+        'uniqueness_score': {'type': 'INTEGER'}
+    },
+    'required': ['ai_score', 'uniqueness_score']
+}
+
+TOPICS_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'title': {'type': 'STRING'},
+            'description': {'type': 'STRING'}
+        },
+        'required': ['title', 'description'],
+        'propertyOrdering': ['title', 'description']
     }
+}
+
+# Кэш оценок качества: sha256(версия промпта + нормализованный текст) -> оценки.
+# LRU в памяти + таблица quality_cache (общая с check-content, версии промптов различаются)
+QUALITY_CACHE_TTL_SEC = int(os.environ.get('QUALITY_CACHE_TTL_SEC', str(30 * 24 * 3600)))
+QUALITY_CACHE_LRU_SIZE = int(os.environ.get('QUALITY_CACHE_LRU_SIZE', '1024'))
+QUALITY_PROMPT_VERSION = 'doc-writer-quality:v2'
+
+# Map-reduce оценки длинных текстов: куски с перекрытием, оцениваются параллельно
+QUALITY_CHUNK_CHARS = int(os.environ.get('QUALITY_CHUNK_CHARS', '3000'))
+QUALITY_CHUNK_OVERLAP = 300
+QUALITY_MAX_CHUNKS = int(os.environ.get('QUALITY_MAX_CHUNKS', '8'))
+QUALITY_CHUNK_WORKERS = int(os.environ.get('QUALITY_CHUNK_WORKERS', '8'))
+_quality_lru = OrderedDict()
+_quality_lru_lock = threading.Lock()
+
+# Таблица замен AI-фраз: "фраза" -> "замена". ",?" внутри фразы - необязательная запятая
+AI_PHRASES_PATH = os.environ.get('AI_PHRASES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai_phrases.json'))
+
+def load_ai_phrases(path: str) -> dict:
+    '''Читает таблицу замен AI-фраз из JSON'''
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def compile_ai_phrases(phrases: dict) -> tuple:
+    '''Собирает все фразы в одно регулярное выражение (префиксное дерево) и таблицу замен.
+    Стоимость поиска зависит от длины фразы, а не от их количества'''
+    trie = {}
+    replacements = {}
+    for phrase, replacement in phrases.items():
+        phrase = phrase.lower()
+        node = trie
+        i = 0
+        while i < len(phrase):
+            token = ',?' if phrase.startswith(',?', i) else phrase[i]
+            node = node.setdefault(token, {})
+            i += len(token)
+        node[''] = True
+        replacements[phrase.replace(',?', '')] = replacement
+    
+    def to_regex(node: dict) -> str:
+        alternatives = [
+            (token if token == ',?' else re.escape(token)) + to_regex(child)
+            for token, child in sorted(node.items()) if token
+        ]
+        if not alternatives:
+            return ''
+        body = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        return f'(?:{body})?' if '' in node else body
     
-    result = text
-    for pattern, replacement in ai_phrases.items():
-        result = re.sub(pattern, replacement, result, flags=re.IGNORECASE)
+    pattern = re.compile(r'\b' + to_regex(trie) + r'\b', re.IGNORECASE)
+    return pattern, replacements
+
+_AI_PHRASES_RE, _AI_PHRASES_REPLACEMENTS = compile_ai_phrases(load_ai_phrases(AI_PHRASES_PATH))
+# Пробелы перед знаком препинания убираем, остальные серии пробелов схлопываем - один проход
+_WHITESPACE_RE = re.compile(r'(\s+(?=[.,;:!?]))|\s+')
+
+def _replace_ai_phrase(match) -> str:
+    found = match.group(0)
+    return _AI_PHRASES_REPLACEMENTS.get(found.lower().replace(',', ''), found)
+
+def _replace_whitespace(match) -> str:
+    return '' if match.group(1) else ' '
+
+def humanize_text(text: str) -> str:
+    '''Пост-процессинг: заменяет AI-фразы на человечные'''
+    result = _AI_PHRASES_RE.sub(_replace_ai_phrase, text)
     
     # Убираем двойные пробелы
-    result = re.sub(r'\s+', ' ', result)
-    result = re.sub(r'\s+([.,;:!?])', r'\1', result)
+    result = _WHITESPACE_RE.sub(_replace_whitespace, result)
     
     return result.strip()
 
-def check_content_quality(text: str, api_key: str, proxy_url: str = None) -> dict:
-    '''Проверяет качество текста через Gemini'''
+def add_usage(usage: dict, gemini_response: dict):
+    '''Суммирует usageMetadata ответа Gemini в usage (для сравнения путей генерации)'''
+    if usage is None:
+        return
+    meta = gemini_response.get('usageMetadata') or {}
+    with _usage_lock:
+        for key in ('promptTokenCount', 'candidatesTokenCount', 'totalTokenCount'):
+            usage[key] = usage.get(key, 0) + meta.get(key, 0)
+        usage['calls'] = usage.get('calls', 0) + 1
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Соединение с отметками пула: когда вернули (None - ещё не выдавалось) и открыто ли сверх пула'''
+    last_used = None
+    overflow = False
+
+def _count_db(*names: str):
+    with _db_stats_lock:
+        for name in names:
+            _db_stats[name] += 1
+
+def _get_db_pool(dsn: str):
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    max(1, min(DB_POOL_WARM, DB_POOL_SIZE)), DB_POOL_SIZE,
+                    os.environ.get('DATABASE_POOL_URL') or dsn, connection_factory=PooledConnection
+                )
+                # putconn держит у себя не больше minconn соединений, остальные закрывает.
+                # Открываем DB_POOL_WARM сразу, но храним между вызовами до DB_POOL_SIZE
+                pool.minconn = DB_POOL_SIZE
+                _db_pool = pool
+    return _db_pool
+
+def _db_alive(conn) -> bool:
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def get_db_connection(dsn: str):
+    '''Берёт соединение из пула (с проверкой устаревших), при исчерпании пула - открывает отдельное'''
+    t_start = time.perf_counter()
+    pool = _get_db_pool(dsn)
+    try:
+        conn = pool.getconn()
+        if conn.closed or (conn.last_used is not None and time.time() - conn.last_used > DB_HEALTHCHECK_IDLE_SEC and not _db_alive(conn)):
+            pool.putconn(conn, close=True)
+            _count_db('reconnected')
+            conn = pool.getconn()
+    except psycopg2.pool.PoolError:
+        conn = psycopg2.connect(os.environ.get('DATABASE_POOL_URL') or dsn, connection_factory=PooledConnection)
+        conn.overflow = True
+        _count_db('overflow')
+        print(f"[doc-writer] db acquire_ms={(time.perf_counter() - t_start) * 1000:.1f} reused=False overflow=True")
+        return conn
+    
+    reused = conn.last_used is not None
+    if reused:
+        _count_db('acquired', 'reused')
+    else:
+        _count_db('acquired')
+    with _db_stats_lock:
+        stats = dict(_db_stats)
+    print(f"[doc-writer] db acquire_ms={(time.perf_counter() - t_start) * 1000:.1f} reused={reused} stats={stats}")
+    return conn
+
+def release_db_connection(conn):
+    '''Возвращает соединение в пул в чистом состоянии (без открытой транзакции, autocommit выключен)'''
+    pool = _db_pool
+    if pool is None or getattr(conn, 'overflow', True):
+        conn.close()
+        return
+    try:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = False
+    except Exception:
+        pass
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        return
+    conn.last_used = time.time()
+    pool.putconn(conn)
+
+def add_usage_totals(usage: dict, other: dict):
+    '''Добавляет накопленный usage (например, одного кандидата) к общему'''
+    if usage is None:
+        return
+    with _usage_lock:
+        for key, value in other.items():
+            usage[key] = usage.get(key, 0) + value
+
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?…])\s+')
+_WORD_RE = re.compile(r'\w+')
+_PUNCTUATION = '.,;:!?—–-…()"«»\''
+
+def _clamp01(value: float) -> float:
+    return max(0.0, min(1.0, value))
+
+def estimate_ai_score(text: str) -> dict:
+    '''Быстрая локальная оценка "похожести на ИИ" по стилометрическим признакам, без вызова модели'''
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return {'ai_score': 50, 'uniqueness_score': 50, 'words': 0, 'features': {}}
+    
+    # Плотность штампов на 100 слов
+    stock_density = len(_AI_PHRASES_RE.findall(text)) * 100 / len(words)
+    
+    # Разброс длины предложений: у модели предложения однообразнее
+    lengths = [len(_WORD_RE.findall(sentence)) for sentence in _SENTENCE_SPLIT_RE.split(text.strip())]
+    lengths = [n for n in lengths if n]
+    mean = sum(lengths) / len(lengths)
+    sentence_cv = math.sqrt(sum((n - mean) ** 2 for n in lengths) / len(lengths)) / mean
+    
+    # Доля уникальных слов на фиксированном окне, чтобы не зависеть от длины текста
+    window = words[:300]
+    type_token_ratio = len(set(window)) / len(window)
+    
+    # Энтропия знаков препинания: у человека они разнообразнее
+    counts = {}
+    for ch in text:
+        if ch in _PUNCTUATION:
+            counts[ch] = counts.get(ch, 0) + 1
+    total = sum(counts.values())
+    punctuation_entropy = -sum(c / total * math.log2(c / total) for c in counts.values()) if total else 0.0
+    
+    stock_term = _clamp01(stock_density / 2.0)
+    variance_term = _clamp01((0.6 - sentence_cv) / 0.4)
+    ttr_term = _clamp01((0.75 - type_token_ratio) / 0.25)
+    punctuation_term = _clamp01((1.8 - punctuation_entropy) / 1.3)
+    
+    ai_score = round(100 * (0.4 * stock_term + 0.25 * variance_term + 0.15 * ttr_term + 0.2 * punctuation_term))
+    uniqueness_score = round(100 * (1 - (0.6 * stock_term + 0.4 * ttr_term)))
+    
+    return {
+        'ai_score': ai_score,
+        'uniqueness_score': uniqueness_score,
+        'words': len(words),
+        'features': {
+            'stock_per_100_words': round(stock_density, 2),
+            'sentence_length_cv': round(sentence_cv, 3),
+            'type_token_ratio': round(type_token_ratio, 3),
+            'punctuation_entropy': round(punctuation_entropy, 3)
+        }
+    }
+
+def prescore_stats() -> dict:
+    '''Сколько проверок качества закрыто локальной оценкой без вызова Gemini'''
+    with _prescore_lock:
+        stats = dict(_prescore_stats)
+    checked = stats['checked']
+    return {**stats, 'skip_rate': round(stats['skipped'] / checked, 3) if checked else 0.0}
+
+def extract_json(text: str):
+    '''Достаёт JSON из ответа модели: целиком, из ```-обёртки или первый сбалансированный объект/массив.
+    ValueError - JSON не найден'''
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start = next((i for i, ch in enumerate(text) if ch in '{['), -1)
+    while start >= 0:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            ch = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch in '{[':
+                depth += 1
+            elif ch in '}]':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        return json.loads(text[start:i + 1])
+                    except ValueError:
+                        break
+        # Скобка не открыла валидный JSON - ищем следующую
+        start = next((i for i in range(start + 1, len(text)) if text[i] in '{['), -1)
+    raise ValueError('JSON не найден в ответе модели')
+
+_SCHEMA_TYPES = {
+    'OBJECT': dict, 'ARRAY': list, 'STRING': str,
+    'INTEGER': (int, float), 'NUMBER': (int, float), 'BOOLEAN': bool
+}
+
+def validate_schema(value, schema: dict, path: str = '$'):
+    '''Проверяет значение по responseSchema (типы и required). ValueError - не совпало'''
+    expected = _SCHEMA_TYPES.get(schema.get('type'))
+    if expected and (not isinstance(value, expected) or (expected != bool and isinstance(value, bool))):
+        raise ValueError(f'{path}: ожидался {schema["type"]}')
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                raise ValueError(f'{path}: нет поля {key}')
+        for key, sub in schema.get('properties', {}).items():
+            if key in value:
+                validate_schema(value[key], sub, f'{path}.{key}')
+    elif isinstance(value, list) and 'items' in schema:
+        for i, item in enumerate(value):
+            validate_schema(item, schema['items'], f'{path}[{i}]')
+
+def parse_structured(text: str, schema: dict, endpoint: str):
+    '''Разбирает структурированный ответ и сверяет со схемой, считая исходы по endpoint.
+    ValueError - ответ не разобрался даже толерантным извлечением'''
+    outcome = 'ok'
+    try:
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = extract_json(text)
+            outcome = 'recovered'
+        validate_schema(value, schema)
+    except ValueError:
+        outcome = 'failed'
+        raise
+    finally:
+        with _parse_lock:
+            stats = _parse_stats.setdefault(endpoint, {'ok': 0, 'recovered': 0, 'failed': 0})
+            stats[outcome] += 1
+    return value
+
+def parse_stats() -> dict:
+    '''Исходы разбора структурированных ответов по endpoint'''
+    with _parse_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _parse_stats.items()}
+
+def quality_cache_key(text: str) -> str:
+    '''Ключ кэша оценки: версия промпта + текст с нормализованными пробелами'''
+    normalized = ' '.join(text.split())
+    return hashlib.sha256(f'{QUALITY_PROMPT_VERSION}\n{normalized}'.encode('utf-8')).hexdigest()
+
+def quality_cache_get(key: str) -> dict:
+    '''Оценка из LRU или Postgres, None - промах'''
+    now = time.time()
+    with _quality_lru_lock:
+        entry = _quality_lru.get(key)
+        if entry and now - entry[0] < QUALITY_CACHE_TTL_SEC:
+            _quality_lru.move_to_end(key)
+            return dict(entry[1])
+        if entry:
+            del _quality_lru[key]
+    
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return None
+    try:
+        conn = get_db_connection(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT result, EXTRACT(EPOCH FROM created_at)
+                FROM quality_cache
+                WHERE cache_key = %s AND created_at > NOW() - %s * INTERVAL '1 second'
+            """, (key, QUALITY_CACHE_TTL_SEC))
+            row = cur.fetchone()
+        finally:
+            release_db_connection(conn)
+    except Exception as e:
+        print(f"Quality cache read failed: {e}")
+        return None
+    if not row:
+        return None
+    result = row[0] if isinstance(row[0], dict) else json.loads(row[0])
+    _quality_lru_put(key, result, float(row[1]))
+    return dict(result)
+
+def _quality_lru_put(key: str, result: dict, created_at: float):
+    with _quality_lru_lock:
+        _quality_lru[key] = (created_at, dict(result))
+        _quality_lru.move_to_end(key)
+        while len(_quality_lru) > QUALITY_CACHE_LRU_SIZE:
+            _quality_lru.popitem(last=False)
+
+def quality_cache_put(key: str, result: dict):
+    '''Сохраняет оценку в LRU и Postgres, попутно удаляя просроченные записи'''
+    _quality_lru_put(key, result, time.time())
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return
+    try:
+        conn = get_db_connection(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO quality_cache (cache_key, result, created_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (cache_key) DO UPDATE SET result = EXCLUDED.result, created_at = NOW()
+            """, (key, json.dumps(result, ensure_ascii=False)))
+            cur.execute("DELETE FROM quality_cache WHERE created_at < NOW() - %s * INTERVAL '1 second'", (QUALITY_CACHE_TTL_SEC,))
+            conn.commit()
+        finally:
+            release_db_connection(conn)
+    except Exception as e:
+        print(f"Quality cache write failed: {e}")
+
+def split_text_chunks(text: str, size: int = QUALITY_CHUNK_CHARS, overlap: int = QUALITY_CHUNK_OVERLAP) -> list:
+    '''Режет текст на куски до size символов с перекрытием overlap, по границе слова'''
+    if len(text) <= size:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind(' ', start + size // 2, end)
+            end = cut if cut > 0 else end
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        # Перекрытие начинаем с целого слова
+        space = text.find(' ', start, end)
+        start = space + 1 if space >= 0 else start
+    return chunks
+
+def _score_quality_chunk(chunk: str, api_key: str, proxy_url: str = None, usage: dict = None) -> dict:
+    '''Оценка одного куска текста через Gemini, None - модель ничего не вернула'''
     prompt = f"""Проанализируй текст по двум критериям:
 
 ТЕКСТ:
-{text[:3000]}
+{chunk}
 
 ЗАДАЧИ:
 1. AI-детекция: Оцени от 0 до 100, насколько текст похож на сгенерированный ИИ
@@ -67,7 +539,11 @@ def check_content_quality(text: str, api_key: str, proxy_url: str = None) -> dic
     gemini_request = {
         'contents': [{
             'parts': [{'text': prompt}]
-        }]
+        }],
+        'generationConfig': {
+            'responseMimeType': 'application/json',
+            'responseSchema': QUALITY_SCORES_SCHEMA
+        }
     }
     
     req = urllib.request.Request(
@@ -83,18 +559,74 @@ def check_content_quality(text: str, api_key: str, proxy_url: str = None) -> dic
     
     with urllib.request.urlopen(req, timeout=30) as response:
         gemini_response = json.loads(response.read().decode('utf-8'))
+    add_usage(usage, gemini_response)
     
     if 'candidates' in gemini_response and gemini_response['candidates']:
-        result_text = gemini_response['candidates'][0]['content']['parts'][0]['text'].strip()
-        
-        if result_text.startswith('```'):
-            lines = result_text.split('\n')
-            result_text = '\n'.join(lines[1:-1]) if len(lines) > 2 else result_text
-            result_text = result_text.replace('```json', '').replace('```', '').strip()
-        
-        return json.loads(result_text)
+        result_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
+        return parse_structured(result_text, QUALITY_SCORES_SCHEMA, 'check_quality')
     
-    return {'ai_score': 50, 'uniqueness_score': 50}
+    return None
+
+def check_content_quality(text: str, api_key: str, proxy_url: str = None, usage: dict = None, prescore: bool = True, band: tuple = None) -> dict:
+    '''Проверяет качество текста через Gemini. Повтор того же текста берётся из кэша,
+    уверенная локальная оценка (вне полосы band) обходится без вызова модели.
+    Длинный текст оценивается по кускам параллельно, оценки усредняются с весом по длине'''
+    cache_key = quality_cache_key(text)
+    cached = quality_cache_get(cache_key)
+    if cached:
+        cached['cached'] = True
+        return cached
+    
+    if prescore:
+        low, high = band or (PRESCORE_LOW, PRESCORE_HIGH)
+        local = estimate_ai_score(text)
+        confident = local['words'] >= PRESCORE_MIN_WORDS and (local['ai_score'] < low or local['ai_score'] > high)
+        # Кандидаты цикла качества и куски текста оцениваются из разных потоков
+        with _prescore_lock:
+            _prescore_stats['checked'] += 1
+            if confident:
+                _prescore_stats['skipped'] += 1
+        if confident:
+            return {'ai_score': local['ai_score'], 'uniqueness_score': local['uniqueness_score'], 'source': 'local'}
+    
+    chunks = split_text_chunks(text)
+    if len(chunks) > QUALITY_MAX_CHUNKS:
+        chunks = split_text_chunks(text, math.ceil(len(text) / QUALITY_MAX_CHUNKS) + QUALITY_CHUNK_OVERLAP)
+    
+    if len(chunks) == 1:
+        scored = [(chunks[0], _score_quality_chunk(chunks[0], api_key, proxy_url, usage))]
+    else:
+        with ThreadPoolExecutor(max_workers=min(QUALITY_CHUNK_WORKERS, len(chunks))) as pool:
+            futures = [pool.submit(_score_quality_chunk, chunk, api_key, proxy_url, usage) for chunk in chunks]
+            scored = []
+            error = None
+            for chunk, future in zip(chunks, futures):
+                try:
+                    scored.append((chunk, future.result()))
+                except Exception as e:
+                    print(f"Quality chunk failed: {e}")
+                    error = e
+            if not scored and error:
+                raise error
+    
+    scored = [(chunk, scores) for chunk, scores in scored if scores]
+    if not scored:
+        return {'ai_score': 50, 'uniqueness_score': 50}
+    
+    total = sum(len(chunk) for chunk, _ in scored)
+    result = {
+        'ai_score': round(sum(s.get('ai_score', 50) * len(c) for c, s in scored) / total),
+        'uniqueness_score': round(sum(s.get('uniqueness_score', 50) * len(c) for c, s in scored) / total)
+    }
+    if len(chunks) > 1:
+        result['chunks'] = [
+            {'ai_score': s.get('ai_score', 50), 'uniqueness_score': s.get('uniqueness_score', 50), 'chars': len(c)}
+            for c, s in scored
+        ]
+    # Частичный результат (часть кусков упала) не кэшируем
+    if len(scored) == len(chunks):
+        quality_cache_put(cache_key, result)
+    return result
 
 def improve_text_prompt(original_prompt: str, iteration: int, quality_level: str) -> str:
     '''Радикально меняет промпт для каждой итерации'''
@@ -155,8 +687,9 @@ def improve_text_prompt(original_prompt: str, iteration: int, quality_level: str
     
     return f"{original_prompt}\n\n{'='*50}\n{strategy_text}\n{'='*50}\n\nТеперь напиши текст полностью по-новому с этим подходом!"
 
-def generate_with_gemini(prompt: str, api_key: str, proxy_url: str = None) -> str:
-    '''Генерирует текст через Gemini API БЕЗ retry (retry на фронтенде)'''
+def generate_with_gemini(prompt: str, api_key: str, proxy_url: str = None, usage: dict = None, schema: dict = None) -> str:
+    '''Генерирует текст через Gemini API БЕЗ retry (retry на фронтенде).
+    С schema ответ ограничен JSON по responseSchema'''
     gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
     
     gemini_request = {
@@ -164,6 +697,8 @@ def generate_with_gemini(prompt: str, api_key: str, proxy_url: str = None) -> st
             'parts': [{'text': prompt}]
         }]
     }
+    if schema:
+        gemini_request['generationConfig'] = {'responseMimeType': 'application/json', 'responseSchema': schema}
     
     req = urllib.request.Request(
         gemini_url,
@@ -179,6 +714,7 @@ def generate_with_gemini(prompt: str, api_key: str, proxy_url: str = None) -> st
     try:
         with urllib.request.urlopen(req, timeout=45) as response:
             gemini_response = json.loads(response.read().decode('utf-8'))
+            add_usage(usage, gemini_response)
             if 'candidates' in gemini_response and gemini_response['candidates']:
                 return gemini_response['candidates'][0]['content']['parts'][0]['text'].strip()
             raise Exception('Не удалось сгенерировать текст')
@@ -189,6 +725,823 @@ def generate_with_gemini(prompt: str, api_key: str, proxy_url: str = None) -> st
     except Exception as e:
         raise Exception(f'Ошибка генерации: {str(e)}')
 
+def stream_with_gemini(prompt: str, api_key: str, proxy_url: str = None, on_chunk=None, usage: dict = None) -> str:
+    '''Генерирует текст через streamGenerateContent (SSE), отдавая фрагменты в on_chunk по мере поступления'''
+    gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse&key={api_key}'
+    
+    gemini_request = {
+        'contents': [{
+            'parts': [{'text': prompt}]
+        }]
+    }
+    
+    req = urllib.request.Request(
+        gemini_url,
+        data=json.dumps(gemini_request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    
+    pieces = []
+    last_chunk = {}
+    try:
+        # timeout действует на каждое чтение сокета, а не на весь ответ
+        with urllib.request.urlopen(req, timeout=45) as response:
+            for raw_line in response:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                chunk = json.loads(line[5:].strip())
+                last_chunk = chunk
+                for candidate in chunk.get('candidates') or []:
+                    for part in (candidate.get('content') or {}).get('parts') or []:
+                        piece = part.get('text')
+                        if piece:
+                            pieces.append(piece)
+                            if on_chunk:
+                                on_chunk(piece)
+    except urllib.error.HTTPError as e:
+        if e.code == 429:
+            raise Exception('Rate limit. Retry on frontend')
+        raise Exception(f'HTTP Error {e.code}')
+    except Exception as e:
+        raise Exception(f'Ошибка генерации: {str(e)}')
+    
+    # usageMetadata в потоке накопительный - берём из последнего фрагмента
+    add_usage(usage, last_chunk)
+    text = ''.join(pieces).strip()
+    if not text:
+        raise Exception('Ошибка генерации: Не удалось сгенерировать текст')
+    return text
+
+SECTION_FUSED_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'text': {'type': 'STRING'},
+        'ai_score': {'type': 'INTEGER'},
+        'uniqueness_score': {'type': 'INTEGER'}
+    },
+    'required': ['text', 'ai_score', 'uniqueness_score'],
+    'propertyOrdering': ['text', 'ai_score', 'uniqueness_score']
+}
+
+def generate_section_fused(prompt: str, api_key: str, proxy_url: str = None, usage: dict = None) -> dict:
+    '''Генерирует раздел и самооценку качества одним запросом со структурированным ответом.
+    ValueError - ответ не разобрался (вызывающий код переходит на два запроса)'''
+    fused_prompt = f"""{prompt}
+
+После того как напишешь текст, критически оцени его:
+- ai_score: от 0 до 100, насколько текст похож на сгенерированный ИИ
+- uniqueness_score: от 0 до 100, насколько оригинальны формулировки
+
+Верни JSON: text - текст раздела, ai_score и uniqueness_score - оценки."""
+
+    gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
+    
+    gemini_request = {
+        'contents': [{
+            'parts': [{'text': fused_prompt}]
+        }],
+        'generationConfig': {
+            'responseMimeType': 'application/json',
+            'responseSchema': SECTION_FUSED_SCHEMA
+        }
+    }
+    
+    req = urllib.request.Request(
+        gemini_url,
+        data=json.dumps(gemini_request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    
+    try:
+        with urllib.request.urlopen(req, timeout=45) as response:
+            gemini_response = json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        if e.code == 429:
+            raise Exception('Rate limit. Retry on frontend')
+        raise Exception(f'HTTP Error {e.code}')
+    add_usage(usage, gemini_response)
+    
+    try:
+        result_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
+        result = parse_structured(result_text, SECTION_FUSED_SCHEMA, 'section_fused')
+        text = str(result['text']).strip()
+        ai_score = int(result['ai_score'])
+        uniqueness_score = int(result['uniqueness_score'])
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise ValueError(f'Некорректный структурированный ответ: {e}')
+    
+    if not text:
+        raise ValueError('Пустой текст в структурированном ответе')
+    
+    return {
+        'text': text,
+        'ai_score': max(0, min(100, ai_score)),
+        'uniqueness_score': max(0, min(100, uniqueness_score))
+    }
+
+def section_target_words(pages: int, topics: list, section_title: str) -> int:
+    '''Сколько слов нужно разделу, чтобы документ набрал заданный объём'''
+    words_per_page = 300
+    total_words_needed = pages * words_per_page
+    sections_count = len(topics) if topics else 5
+    words_for_intro_conclusion = 400
+    words_for_sections = total_words_needed - words_for_intro_conclusion
+    words_per_section = words_for_sections // sections_count if sections_count > 0 else 500
+    
+    if 'введение' in section_title.lower() or 'заключение' in section_title.lower():
+        return 200
+    return words_per_section
+
+def build_section_prompt(doc_type: str, subject: str, pages: int, topics: list, section_title: str, section_description: str, additional_info: str, target_words: int = None) -> str:
+    '''Собирает промпт для генерации одного раздела документа'''
+    if target_words is None:
+        target_words = section_target_words(pages, topics, section_title)
+    
+    # КРИТИЧНО: Ограничиваем до 600 слов max, чтобы успеть за 25 секунд
+    target_words = min(target_words, SECTION_CHUNK_WORDS)
+    
+    return f"""Ты студент, который пишет {doc_type} на тему: {subject}
+
+РАЗДЕЛ: {section_title}
+О ЧЕМ ПИСАТЬ: {section_description}
+
+ТРЕБОВАНИЯ К ОБЪЕМУ:
+- Ровно {target_words} слов (не меньше!)
+
+КАК ПИСАТЬ (КРИТИЧНО ВАЖНО):
+1. Пиши ПРОСТЫМ языком, как объясняешь другу
+2. КОРОТКИЕ и ДЛИННЫЕ предложения вперемешку
+3. Используй АКТИВНЫЙ залог
+4. Приводи КОНКРЕТНЫЕ примеры, цифры, факты
+5. НЕ используй штампы: "в современном мире", "важно отметить", "следует подчеркнуть"
+6. Начни с КОНКРЕТНОГО факта или примера
+7. Добавь ЛИЧНЫЕ наблюдения: "на практике видно...", "интересно, что..."
+8. Используй риторические вопросы иногда
+9. Пиши так, чтобы было интересно читать
+
+{f"ДОПОЛНИТЕЛЬНО: {additional_info}" if additional_info else ''}
+
+ВАЖНО: 
+- Текст должен звучать как написал человек, а не робот
+- {target_words} слов - строго!
+- Напиши ТОЛЬКО текст раздела без заголовка"""
+
+def _section_plan(doc_type: str, subject: str, section_title: str, section_description: str, parts: int, api_key: str, proxy_url: str = None, usage: dict = None) -> list:
+    '''Короткий общий план длинного раздела: по одному пункту на каждую часть'''
+    prompt = f"""Составь план раздела "{section_title}" для {doc_type} на тему: {subject}
+О чем раздел: {section_description}
+
+Ровно {parts} пунктов, каждый - одно предложение о том, что раскрыть в этой части.
+Пункты не должны повторять друг друга. Верни только пункты, по одному в строке, без нумерации."""
+    try:
+        with _gemini_slots:
+            text = generate_with_gemini(prompt, api_key, proxy_url, usage)
+        points = [line.strip(' -*\t0123456789.)') for line in text.split('\n')]
+        points = [point for point in points if point]
+        if len(points) >= parts:
+            return points[:parts]
+    except Exception as e:
+        print(f"Section plan failed: {e}")
+    return [f'Часть {i + 1} из {parts}: {section_description}' for i in range(parts)]
+
+def _section_transition(previous_part: str, next_part: str, api_key: str, proxy_url: str = None, usage: dict = None) -> str:
+    '''1-2 связующих предложения между соседними частями раздела'''
+    prompt = f"""Два соседних фрагмента одного текста написаны отдельно. Напиши 1-2 коротких предложения-связки, которые естественно переводят от первого ко второму.
+
+КОНЕЦ ПЕРВОГО ФРАГМЕНТА:
+...{previous_part[-400:]}
+
+НАЧАЛО ВТОРОГО ФРАГМЕНТА:
+{next_part[:400]}...
+
+Верни только связку, без кавычек и пояснений."""
+    try:
+        with _gemini_slots:
+            return generate_with_gemini(prompt, api_key, proxy_url, usage)
+    except Exception as e:
+        print(f"Section transition failed: {e}")
+        return ''
+
+def _generate_in_slot(prompt: str, api_key: str, proxy_url: str = None, usage: dict = None) -> str:
+    with _gemini_slots:
+        return generate_with_gemini(prompt, api_key, proxy_url, usage)
+
+def generate_long_section(doc_type: str, subject: str, pages: int, topics: list, section_title: str, section_description: str, additional_info: str, api_key: str, proxy_url: str = None, usage: dict = None, on_part=None) -> str:
+    '''Пишет длинный раздел частями по общему плану: части и связки между ними генерируются параллельно,
+    поэтому ни один запрос к Gemini не длиннее обычного раздела. Частей столько, сколько нужно объёму
+    (но не больше SECTION_MAX_CHUNKS). on_part получает готовые части по порядку - для потокового показа'''
+    total_words = section_target_words(pages, topics, section_title)
+    parts = math.ceil(total_words / SECTION_CHUNK_WORDS)
+    if parts > SECTION_MAX_CHUNKS:
+        print(f"Section '{section_title}' needs {parts} parts, capped at {SECTION_MAX_CHUNKS}: text will be shorter than {total_words} words")
+        parts = SECTION_MAX_CHUNKS
+    part_words = total_words // parts
+    plan = _section_plan(doc_type, subject, section_title, section_description, parts, api_key, proxy_url, usage)
+    plan_text = '\n'.join(f'{i + 1}. {point}' for i, point in enumerate(plan))
+    
+    prompts = []
+    for i, point in enumerate(plan):
+        description = f"""{section_description}
+
+ПЛАН ВСЕГО РАЗДЕЛА:
+{plan_text}
+
+СЕЙЧАС НАПИШИ ТОЛЬКО ЧАСТЬ {i + 1}: {point}
+Не пересказывай другие части, без вступления к разделу и без итогов."""
+        prompts.append(build_section_prompt(doc_type, subject, pages, topics, section_title, description, additional_info, part_words))
+    
+    with ThreadPoolExecutor(max_workers=parts) as pool:
+        texts = []
+        for text in pool.map(lambda part_prompt: _generate_in_slot(part_prompt, api_key, proxy_url, usage), prompts):
+            texts.append(text)
+            if on_part:
+                on_part(text + '\n\n')
+        transitions = list(pool.map(
+            lambda pair: _section_transition(pair[0], pair[1], api_key, proxy_url, usage),
+            zip(texts, texts[1:])
+        ))
+    
+    result = texts[0]
+    for transition, text in zip(transitions, texts[1:]):
+        result += '\n\n' + (f'{transition} ' if transition else '') + text
+    return humanize_text(result)
+
+def generate_chunked_section(doc_type: str, subject: str, pages: int, topics: list, section_title: str, section_description: str, additional_info: str, api_key: str, proxy_url: str = None, usage: dict = None, on_part=None) -> dict:
+    '''Длинный раздел частями + одна проверка качества итогового текста.
+    target_words/words - сколько слов нужно и сколько получилось (недобор виден в метриках)'''
+    text = generate_long_section(doc_type, subject, pages, topics, section_title, section_description, additional_info, api_key, proxy_url, usage, on_part)
+    
+    ai_score = None
+    uniqueness_score = None
+    try:
+        with _gemini_slots:
+            scores = check_content_quality(text, api_key, proxy_url, usage)
+        ai_score = scores.get('ai_score', 50)
+        uniqueness_score = scores.get('uniqueness_score', 50)
+    except Exception as e:
+        print(f"Quality check failed: {e}")
+    
+    return {
+        'text': text,
+        'ai_score': ai_score,
+        'uniqueness_score': uniqueness_score,
+        'path': 'chunked',
+        'target_words': section_target_words(pages, topics, section_title),
+        'words': len(text.split())
+    }
+
+class CandidateCancelled(Exception):
+    '''Кандидат цикла качества отменён: другой уже прошёл пороги'''
+
+def generate_section(prompt: str, api_key: str, proxy_url: str = None, fused: bool = False, on_chunk=None, usage: dict = None, cancelled: threading.Event = None) -> dict:
+    '''Генерирует раздел и оценивает его качество (для воркера задачи).
+    С on_chunk текст генерируется потоком, структурированный fused-режим при этом не используется.
+    path в результате - какой путь сработал: fused, fused_fallback, two_call или stream.
+    cancelled - кандидат больше не нужен: новые запросы к Gemini не начинаются'''
+    def check_cancelled():
+        if cancelled is not None and cancelled.is_set():
+            raise CandidateCancelled()
+    
+    if fused and not on_chunk:
+        try:
+            with _gemini_slots:
+                check_cancelled()
+                result = generate_section_fused(prompt, api_key, proxy_url, usage)
+            result['text'] = humanize_text(result['text'])
+            result['path'] = 'fused'
+            return result
+        except ValueError as e:
+            print(f"Fused section parse failed, falling back to two calls: {e}")
+    
+    path = 'stream' if on_chunk else ('fused_fallback' if fused else 'two_call')
+    with _gemini_slots:
+        check_cancelled()
+        if on_chunk:
+            text = humanize_text(stream_with_gemini(prompt, api_key, proxy_url, on_chunk, usage))
+        else:
+            text = humanize_text(generate_with_gemini(prompt, api_key, proxy_url, usage))
+    
+    ai_score = None
+    uniqueness_score = None
+    try:
+        with _gemini_slots:
+            check_cancelled()
+            scores = check_content_quality(text, api_key, proxy_url, usage)
+        ai_score = scores.get('ai_score', 50)
+        uniqueness_score = scores.get('uniqueness_score', 50)
+    except CandidateCancelled:
+        raise
+    except Exception as e:
+        print(f"Quality check failed: {e}")
+    
+    return {'text': text, 'ai_score': ai_score, 'uniqueness_score': uniqueness_score, 'path': path}
+
+def passes_quality(result: dict, settings: dict) -> bool:
+    '''Проходит ли раздел пороги уровня качества'''
+    if result.get('ai_score') is None or result.get('uniqueness_score') is None:
+        return False
+    return result['ai_score'] <= settings['ai_threshold'] and result['uniqueness_score'] >= settings['uniqueness_threshold']
+
+def run_quality_loop(prompt: str, quality_level: str, api_key: str, proxy_url: str = None, fused: bool = False, usage: dict = None) -> dict:
+    '''Генерирует до max_attempts кандидатов параллельно (разные стратегии improve_text_prompt),
+    возвращает первый прошедший пороги, иначе лучший по оценкам.
+    Когда кандидат прошёл, остальным выставляется отмена: они не начинают новых запросов к Gemini
+    (ожидание слота, оценка качества). Уже идущий запрос прервать нельзя - он дорабатывает в фоне
+    и расходует квоту, поэтому уровень качества с max_attempts=N стоит до N генераций'''
+    settings = QUALITY_SETTINGS.get(quality_level, QUALITY_SETTINGS['high'])
+    attempts = max(1, settings['max_attempts'])
+    
+    pool = ThreadPoolExecutor(max_workers=attempts)
+    cancelled = threading.Event()
+    futures = {}
+    for iteration in range(1, attempts + 1):
+        candidate_usage = {}
+        candidate_prompt = improve_text_prompt(prompt, iteration, quality_level)
+        futures[pool.submit(generate_section, candidate_prompt, api_key, proxy_url, fused, None, candidate_usage, cancelled)] = candidate_usage
+    
+    best = None
+    finished = 0
+    last_error = None
+    try:
+        for future in as_completed(futures):
+            finished += 1
+            add_usage_totals(usage, futures[future])
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Candidate failed: {e}")
+                last_error = e
+                continue
+            
+            result['passed'] = passes_quality(result, settings)
+            if result['passed']:
+                best = result
+                break
+            if best is None or _candidate_rank(result) > _candidate_rank(best):
+                best = result
+    finally:
+        # Остальные кандидаты больше не нужны - не ждём их
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    if best is None:
+        raise last_error or Exception('Не удалось сгенерировать текст')
+    
+    best['attempts'] = finished
+    return best
+
+def _candidate_rank(result: dict) -> int:
+    if result.get('ai_score') is None or result.get('uniqueness_score') is None:
+        return -1000
+    return result['uniqueness_score'] - result['ai_score']
+
+def generate_section_streaming(section_id: str, dsn: str, prompt: str, api_key: str, proxy_url: str = None, worker_id: str = None, generate=None) -> dict:
+    '''Потоковая генерация раздела: частичный текст дописывается в БД не чаще раза в STREAM_FLUSH_SEC,
+    чтобы get_status сразу показывал прогресс. Пишет только владелец аренды (worker_id): если раздел
+    уже забрал другой воркер, генерация прерывается.
+    generate(on_part=...) - своя генерация (длинный раздел частями), иначе один потоковый запрос.
+    Цикл качества здесь не запускается: клиент видел бы текст кандидата, который потом заменится'''
+    conn = get_db_connection(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    pending = []
+    last_flush = [time.time()]
+    
+    def on_chunk(piece: str):
+        pending.append(piece)
+        if time.time() - last_flush[0] < STREAM_FLUSH_SEC:
+            return
+        try:
+            cur.execute("""
+                UPDATE document_sections
+                SET content = COALESCE(content, '') || %s, updated_at = clock_timestamp()
+                WHERE id = %s AND worker_id = %s
+            """, (''.join(pending), section_id, worker_id))
+            lost = cur.rowcount == 0
+            pending.clear()
+        except Exception as e:
+            # Промежуточная запись не критична: итоговый текст запишет воркер
+            print(f"Section {section_id} partial flush failed: {e}")
+            lost = False
+        last_flush[0] = time.time()
+        if lost:
+            raise Exception(f'аренда раздела {section_id} перешла другому воркеру')
+    
+    try:
+        cur.execute(
+            "UPDATE document_sections SET content = '', updated_at = clock_timestamp() WHERE id = %s AND worker_id = %s",
+            (section_id, worker_id)
+        )
+        if cur.rowcount == 0:
+            raise Exception(f'аренда раздела {section_id} перешла другому воркеру')
+        if generate:
+            return generate(on_part=on_chunk)
+        return generate_section(prompt, api_key, proxy_url, on_chunk=on_chunk)
+    finally:
+        release_db_connection(conn)
+
+def _claim_sections(cur, worker_id: str, job_id: str = None, limit: int = 1) -> list:
+    '''Забирает разделы в работу: pending, упавшие (пока не исчерпаны попытки и прошла пауза retry_after)
+    и с истёкшей арендой. SKIP LOCKED - параллельные воркеры не получат один и тот же раздел'''
+    cur.execute("""
+        UPDATE document_sections
+        SET status = 'processing',
+            worker_id = %s,
+            lease_expires_at = NOW() + %s * INTERVAL '1 second',
+            attempt_num = CASE WHEN lease_expires_at IS NULL THEN attempt_num ELSE attempt_num + 1 END,
+            updated_at = clock_timestamp()
+        WHERE id IN (
+            SELECT id FROM document_sections
+            WHERE (%s::uuid IS NULL OR job_id = %s::uuid)
+              AND (
+                  status = 'pending'
+                  OR (status = 'error' AND attempt_num < %s AND (retry_after IS NULL OR retry_after <= NOW()))
+                  OR (status = 'processing' AND lease_expires_at < NOW() AND attempt_num < %s)
+              )
+            ORDER BY created_at, section_index
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, job_id, section_title, section_description
+    """, (worker_id, SECTION_LEASE_SEC, job_id, job_id, SECTION_MAX_ATTEMPTS, SECTION_MAX_ATTEMPTS, limit))
+    return cur.fetchall()
+
+# Раздел ещё может быть дописан: не готов, и либо ждёт/идёт, либо у него остались попытки
+_SECTION_LIVE_SQL = """status <> 'completed' AND (
+    status = 'pending'
+    OR (status = 'processing' AND lease_expires_at >= NOW())
+    OR attempt_num < %s
+)"""
+
+def _next_retry_in(cur, job_id: str = None):
+    '''Через сколько секунд можно забрать следующий упавший раздел (None - повторять нечего)'''
+    cur.execute("""
+        SELECT EXTRACT(EPOCH FROM MIN(retry_after) - NOW()) AS wait_sec
+        FROM document_sections
+        WHERE (%s::uuid IS NULL OR job_id = %s::uuid)
+          AND status = 'error' AND attempt_num < %s AND retry_after IS NOT NULL
+    """, (job_id, job_id, SECTION_MAX_ATTEMPTS))
+    row = cur.fetchone()
+    wait_sec = row['wait_sec'] if row else None
+    return None if wait_sec is None else max(0.0, float(wait_sec))
+
+# Работа, которую ещё можно забрать сейчас или позже: ждёт, упала с оставшимися попытками или аренда истекла
+_SECTION_CLAIMABLE_SQL = """(
+    status = 'pending'
+    OR (status = 'error' AND attempt_num < %s)
+    OR (status = 'processing' AND lease_expires_at < NOW() AND attempt_num < %s)
+)"""
+
+def _has_claimable_sections(cur, job_id: str = None) -> bool:
+    '''Остались ли разделы для следующего воркера (по задаче или по всей очереди)'''
+    cur.execute(f"""
+        SELECT 1 FROM document_sections
+        WHERE (%s::uuid IS NULL OR job_id = %s::uuid) AND {_SECTION_CLAIMABLE_SQL}
+        LIMIT 1
+    """, (job_id, job_id, SECTION_MAX_ATTEMPTS, SECTION_MAX_ATTEMPTS))
+    return cur.fetchone() is not None
+
+def run_job_sections(job_id: str, dsn: str, api_key: str, proxy_url: str = None, max_concurrency: int = None, fused: bool = False, stream: bool = False) -> dict:
+    '''Воркер очереди разделов: забирает разделы задачи (или любых задач, если job_id не указан),
+    генерирует их параллельно и записывает результат по мере готовности. Освободившийся слот сразу
+    забирает следующий раздел, поэтому несколько воркеров вместе разбирают очередь.
+    Аренда идущих разделов продлевается каждые SECTION_LEASE_RENEW_SEC; упавший раздел ждёт паузу
+    retry_after - воркер дожидается её, если успевает до дедлайна, иначе передаёт задачу новому вызову.
+    После WORKER_MAX_RUN_SEC новые разделы не забираются: воркер дописывает начатые и, если работа
+    осталась (pending, упавшие, с истёкшей арендой), запускает следующий вызов'''
+    conn = get_db_connection(dsn)
+    conn.autocommit = False
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    worker_id = uuid.uuid4().hex
+    deadline = time.time() + WORKER_MAX_RUN_SEC
+    
+    try:
+        if job_id:
+            cur.execute("SELECT 1 FROM document_jobs WHERE id = %s", (job_id,))
+            if not cur.fetchone():
+                conn.rollback()
+                return {'claimed': 0, 'completed': 0, 'failed': 0, 'not_found': True}
+        
+        workers = max(1, min(max_concurrency or SECTION_WORKERS_PER_JOB, SECTION_WORKERS_PER_JOB))
+        jobs = {}
+        touched_jobs = set()
+        claimed = 0
+        completed = 0
+        failed = 0
+        last_renew = time.time()
+        
+        def submit(pool, section):
+            job = jobs[section['job_id']]
+            topics = job['topics'] if isinstance(job['topics'], list) else json.loads(job['topics'] or '[]')
+            prompt = build_section_prompt(
+                job['doc_type'], job['subject'], job['pages'], topics,
+                section['section_title'], section['section_description'] or '', job['additional_info'] or ''
+            )
+            chunked = None
+            if section_target_words(job['pages'], topics, section['section_title']) > SECTION_CHUNK_WORDS:
+                chunked = partial(
+                    generate_chunked_section, job['doc_type'], job['subject'], job['pages'], topics,
+                    section['section_title'], section['section_description'] or '', job['additional_info'] or '', api_key, proxy_url
+                )
+            if stream:
+                return pool.submit(generate_section_streaming, section['id'], dsn, prompt, api_key, proxy_url, worker_id, chunked)
+            if chunked:
+                return pool.submit(chunked)
+            return pool.submit(run_quality_loop, prompt, job['quality_level'] or 'high', api_key, proxy_url, fused)
+        
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            in_flight = {}
+            while True:
+                # Добираем разделы в свободные слоты, пока не вышло время вызова
+                if len(in_flight) < workers and time.time() < deadline:
+                    sections = _claim_sections(cur, worker_id, job_id, workers - len(in_flight))
+                    conn.commit()
+                    new_jobs = list({section['job_id'] for section in sections if section['job_id'] not in jobs})
+                    if new_jobs:
+                        cur.execute("""
+                            SELECT id, doc_type, subject, pages, topics, additional_info, quality_level
+                            FROM document_jobs
+                            WHERE id = ANY(%s::uuid[])
+                        """, (new_jobs,))
+                        jobs.update({row['id']: row for row in cur.fetchall()})
+                        conn.commit()
+                    for section in sections:
+                        in_flight[submit(pool, section)] = section
+                        touched_jobs.add(section['job_id'])
+                    claimed += len(sections)
+                
+                if not in_flight:
+                    if time.time() >= deadline:
+                        # Время вызова вышло: оставшиеся разделы передаём новому вызову
+                        leftover = _has_claimable_sections(cur, job_id)
+                        conn.commit()
+                        if leftover:
+                            trigger_job_worker(job_id, stream)
+                        break
+                    wait_sec = _next_retry_in(cur, job_id)
+                    conn.commit()
+                    if wait_sec is None:
+                        break
+                    if time.time() + wait_sec < deadline:
+                        time.sleep(wait_sec + 0.05)
+                        continue
+                    if wait_sec < WORKER_MAX_RUN_SEC:
+                        trigger_job_worker(job_id, stream)
+                    break
+                
+                # Соединение используется только из этого потока: пишем каждый раздел сразу по готовности.
+                # Условие worker_id: если аренда истекла и раздел забрал другой воркер, его результат не затираем
+                done, _ = wait(in_flight, timeout=SECTION_LEASE_RENEW_SEC, return_when=FIRST_COMPLETED)
+                if time.time() - last_renew >= SECTION_LEASE_RENEW_SEC:
+                    cur.execute("""
+                        UPDATE document_sections
+                        SET lease_expires_at = NOW() + %s * INTERVAL '1 second'
+                        WHERE id = ANY(%s::uuid[]) AND worker_id = %s AND status = 'processing'
+                    """, (SECTION_LEASE_SEC, [str(section['id']) for section in in_flight.values()], worker_id))
+                    conn.commit()
+                    last_renew = time.time()
+                for future in done:
+                    section_id = in_flight.pop(future)['id']
+                    try:
+                        result = future.result()
+                        cur.execute("""
+                            UPDATE document_sections
+                            SET content = %s, ai_score = %s, uniqueness_score = %s, status = 'completed',
+                                lease_expires_at = NULL, updated_at = clock_timestamp()
+                            WHERE id = %s AND worker_id = %s
+                        """, (result['text'], result['ai_score'], result['uniqueness_score'], section_id, worker_id))
+                        completed += 1
+                    except Exception as e:
+                        print(f"Section {section_id} failed: {e}")
+                        cur.execute("""
+                            UPDATE document_sections
+                            SET status = 'error',
+                                retry_after = clock_timestamp() + %s * POWER(2, attempt_num - 1) * INTERVAL '1 second',
+                                updated_at = clock_timestamp()
+                            WHERE id = %s AND worker_id = %s
+                        """, (SECTION_RETRY_BASE_SEC, section_id, worker_id))
+                        failed += 1
+                    conn.commit()
+        
+        # Задача завершена, если готовы все разделы, и провалена, если оставшимся больше не будет попыток
+        for touched_job_id in touched_jobs:
+            cur.execute(f"""
+                UPDATE document_jobs
+                SET status = CASE
+                        WHEN NOT EXISTS (
+                            SELECT 1 FROM document_sections WHERE job_id = %s AND status <> 'completed'
+                        ) THEN 'completed'
+                        WHEN NOT EXISTS (
+                            SELECT 1 FROM document_sections WHERE job_id = %s AND {_SECTION_LIVE_SQL}
+                        ) THEN 'error'
+                        ELSE status END,
+                    updated_at = NOW()
+                WHERE id = %s
+            """, (touched_job_id, touched_job_id, SECTION_MAX_ATTEMPTS, touched_job_id))
+        conn.commit()
+        
+        return {'worker_id': worker_id, 'claimed': claimed, 'completed': completed, 'failed': failed}
+    finally:
+        release_db_connection(conn)
+
+def trigger_job_worker(job_id: str = None, stream: bool = False):
+    '''Самовызов функции для запуска воркера задачи (как в generate-video); без job_id - воркер всей очереди'''
+    fn_url = os.environ.get('FUNCTION_URL', 'https://functions.yandexcloud.net/d4ep127ik5qbfueas45d')
+    payload = {'mode': 'run_job', 'job_id': job_id, 'stream': stream} if job_id else {'mode': 'run_queue', 'stream': stream}
+    try:
+        req = urllib.request.Request(
+            fn_url,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        urllib.request.urlopen(req, timeout=3)
+    except Exception as e:
+        print(f"[doc-writer] worker trigger: {e}")
+
+def outline_cache_key(doc_type: str, subject: str, pages: int, additional_info: str) -> str:
+    '''Ключ кэша структуры по нормализованным входным данным'''
+    def norm(value) -> str:
+        return ' '.join(str(value or '').lower().split())
+    payload = json.dumps([OUTLINE_PROMPT_VERSION, norm(doc_type), norm(subject), int(pages or 0), norm(additional_info)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def outline_cache_get(key: str, dsn: str = None) -> tuple:
+    '''Ищет структуру в LRU, затем в Postgres. Возвращает (topics, 'lru' | 'db') или (None, 'miss')'''
+    now = time.time()
+    with _outline_lru_lock:
+        entry = _outline_lru.get(key)
+        if entry and now - entry[0] < OUTLINE_CACHE_TTL_SEC:
+            _outline_lru.move_to_end(key)
+            _outline_cache_stats['lru_hit'] += 1
+            return entry[1], 'lru'
+        if entry:
+            del _outline_lru[key]
+    
+    if dsn:
+        try:
+            conn = get_db_connection(dsn)
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT topics, EXTRACT(EPOCH FROM created_at)
+                    FROM outline_cache
+                    WHERE cache_key = %s AND created_at > NOW() - %s * INTERVAL '1 second'
+                """, (key, OUTLINE_CACHE_TTL_SEC))
+                row = cur.fetchone()
+            finally:
+                release_db_connection(conn)
+            if row:
+                topics = row[0] if isinstance(row[0], list) else json.loads(row[0])
+                _outline_lru_put(key, topics, float(row[1]))
+                _count_outline_cache('db_hit')
+                return topics, 'db'
+        except Exception as e:
+            print(f"Outline cache read failed: {e}")
+    
+    _count_outline_cache('miss')
+    return None, 'miss'
+
+def _count_outline_cache(name: str):
+    with _outline_lru_lock:
+        _outline_cache_stats[name] += 1
+
+def outline_cache_stats() -> dict:
+    '''Счётчики попаданий в кэш структуры'''
+    with _outline_lru_lock:
+        return dict(_outline_cache_stats)
+
+def _outline_lru_put(key: str, topics: list, created_at: float):
+    with _outline_lru_lock:
+        _outline_lru[key] = (created_at, topics)
+        _outline_lru.move_to_end(key)
+        while len(_outline_lru) > OUTLINE_CACHE_LRU_SIZE:
+            _outline_lru.popitem(last=False)
+
+def outline_cache_put(key: str, topics: list, dsn: str = None):
+    '''Сохраняет структуру в LRU и Postgres, попутно удаляя просроченные записи'''
+    _outline_lru_put(key, topics, time.time())
+    if not dsn:
+        return
+    try:
+        conn = get_db_connection(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO outline_cache (cache_key, topics, created_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (cache_key) DO UPDATE SET topics = EXCLUDED.topics, created_at = NOW()
+            """, (key, json.dumps(topics, ensure_ascii=False)))
+            cur.execute("DELETE FROM outline_cache WHERE created_at < NOW() - %s * INTERVAL '1 second'", (OUTLINE_CACHE_TTL_SEC,))
+            conn.commit()
+        finally:
+            release_db_connection(conn)
+    except Exception as e:
+        print(f"Outline cache write failed: {e}")
+
+_DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+</Types>"""
+
+_DOCX_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+_XML_INVALID_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _docx_paragraph(text: str, size: int = None, bold: bool = False) -> str:
+    run_props = ''
+    if bold or size:
+        run_props = '<w:rPr>' + ('<w:b/>' if bold else '') + (f'<w:sz w:val="{size}"/>' if size else '') + '</w:rPr>'
+    text = xml_escape(_XML_INVALID_RE.sub('', text))
+    return f'<w:p><w:r>{run_props}<w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
+def _get_s3():
+    '''Клиент S3 создаётся один раз на тёплый контейнер: boto3-клиент потокобезопасен, а его сборка - десятки мс'''
+    global _s3_client
+    bucket = os.environ.get('S3_BUCKET')
+    key_id = os.environ.get('S3_ACCESS_KEY')
+    secret = os.environ.get('S3_SECRET_KEY')
+    if not (bucket and key_id and secret):
+        return None, None
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url='https://storage.yandexcloud.net',
+                    aws_access_key_id=key_id,
+                    aws_secret_access_key=secret,
+                )
+    return _s3_client, bucket
+
+def export_document(job_id: str, dsn: str, export_format: str, out) -> bool:
+    '''Пишет документ задачи в out (Markdown или DOCX), читая разделы серверным курсором по одному
+    в порядке section_index - весь документ в памяти не собирается. False - задача не найдена'''
+    conn = get_db_connection(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT doc_type, subject FROM document_jobs WHERE id = %s", (job_id,))
+        job = cur.fetchone()
+        cur.close()
+        if not job:
+            return False
+        doc_type, subject = job
+        
+        sections = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        sections.itersize = 1
+        sections.execute("""
+            SELECT section_title, content
+            FROM document_sections
+            WHERE job_id = %s
+            ORDER BY section_index
+        """, (job_id,))
+        
+        if export_format == 'docx':
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as docx:
+                docx.writestr('[Content_Types].xml', _DOCX_CONTENT_TYPES)
+                docx.writestr('_rels/.rels', _DOCX_RELS)
+                with docx.open('word/document.xml', 'w') as document:
+                    document.write(
+                        b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+                    )
+                    document.write(_docx_paragraph(doc_type.upper(), size=36, bold=True).encode('utf-8'))
+                    document.write(_docx_paragraph(f'Тема: {subject}', size=28).encode('utf-8'))
+                    for title, content in sections:
+                        chunk = [_docx_paragraph(title, size=32, bold=True)]
+                        chunk.extend(_docx_paragraph(line) for line in (content or '').split('\n') if line.strip())
+                        document.write(''.join(chunk).encode('utf-8'))
+                    document.write(b'<w:sectPr/></w:body></w:document>')
+        else:
+            out.write(f'# {doc_type.upper()}\n\nТема: {subject}\n'.encode('utf-8'))
+            for title, content in sections:
+                out.write(f'\n## {title}\n\n{(content or "").strip()}\n'.encode('utf-8'))
+        
+        sections.close()
+        return True
+    finally:
+        release_db_connection(conn)
+
 def handler(event: dict, context) -> dict:
     '''Генерирует структуру или полный документ с автопроверкой качества через Gemini API'''
     
@@ -216,7 +1569,11 @@ def handler(event: dict, context) -> dict:
         }
     
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = json.loads(event.get('body') or '{}')
+        if not event.get('body') and event.get('messages'):
+            # Триггер-таймер (раз в несколько минут): run_queue подбирает разделы, аренда которых
+            # истекла из-за упавшего воркера, и задачи, которые никто не продолжил
+            body = {'mode': 'run_queue'}
         mode = body.get('mode', 'document')
         doc_type = body.get('docType', 'реферат')
         subject = body.get('subject', '')
@@ -238,14 +1595,7 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        # Настройки по уровню качества
-        quality_settings = {
-            'standard': {'max_attempts': 1, 'ai_threshold': 85, 'uniqueness_threshold': 30},
-            'high': {'max_attempts': 2, 'ai_threshold': 70, 'uniqueness_threshold': 50},
-            'max': {'max_attempts': 3, 'ai_threshold': 60, 'uniqueness_threshold': 60}
-        }
-        
-        settings = quality_settings.get(quality_level, quality_settings['high'])
+        settings = QUALITY_SETTINGS.get(quality_level, QUALITY_SETTINGS['high'])
         
         if mode == 'create_job':
             dsn = os.environ.get('DATABASE_URL')
@@ -257,35 +1607,40 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
-            conn = psycopg2.connect(dsn)
-            conn.autocommit = False
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            conn = get_db_connection(dsn)
+            try:
+                conn.autocommit = False
+                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
             
-            # Создаём задачу
-            cur.execute("""
-                INSERT INTO document_jobs (doc_type, subject, pages, topics, additional_info, quality_level, status)
-                VALUES (%s, %s, %s, %s, %s, %s, 'processing')
-                RETURNING id
-            """, (doc_type, subject, pages, json.dumps(topics), additional_info, quality_level))
-            job = cur.fetchone()
-            job_id = job['id']
+                # Создаём задачу
+                cur.execute("""
+                    INSERT INTO document_jobs (doc_type, subject, pages, topics, additional_info, quality_level, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, 'processing')
+                    RETURNING id
+                """, (doc_type, subject, pages, json.dumps(topics), additional_info, quality_level))
+                job = cur.fetchone()
+                job_id = job['id']
             
-            # Создаём разделы: введение, основные разделы, заключение
-            sections_to_create = []
-            sections_to_create.append((job_id, 0, 'Введение', f'Введение к {doc_type} на тему "{subject}"'))
+                # Создаём разделы: введение, основные разделы, заключение
+                sections_to_create = []
+                sections_to_create.append((job_id, 0, 'Введение', f'Введение к {doc_type} на тему "{subject}"'))
             
-            for i, topic in enumerate(topics):
-                sections_to_create.append((job_id, i + 1, topic['title'], topic['description']))
+                for i, topic in enumerate(topics):
+                    sections_to_create.append((job_id, i + 1, topic['title'], topic['description']))
             
-            sections_to_create.append((job_id, len(topics) + 1, 'Заключение', f'Заключение к {doc_type} на тему "{subject}"'))
+                sections_to_create.append((job_id, len(topics) + 1, 'Заключение', f'Заключение к {doc_type} на тему "{subject}"'))
             
-            cur.executemany("""
-                INSERT INTO document_sections (job_id, section_index, section_title, section_description, status)
-                VALUES (%s, %s, %s, %s, 'pending')
-            """, sections_to_create)
+                cur.executemany("""
+                    INSERT INTO document_sections (job_id, section_index, section_title, section_description, status)
+                    VALUES (%s, %s, %s, %s, 'pending')
+                """, sections_to_create)
             
-            conn.commit()
-            conn.close()
+                conn.commit()
+            finally:
+                release_db_connection(conn)
+            
+            if body.get('autostart'):
+                trigger_job_worker(str(job_id), stream=bool(body.get('stream')))
             
             return {
                 'statusCode': 200,
@@ -294,8 +1649,51 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
-        if mode == 'get_status':
+        if mode in ('run_job', 'run_queue'):
+            # run_queue - разбирать разделы всех задач, run_job - только указанной.
+            # run_queue также вызывается триггером-таймером, чтобы подбирать истёкшие аренды
+            job_id = body.get('job_id')
+            if not job_id and mode == 'run_job':
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'job_id не указан'}),
+                    'isBase64Encoded': False
+                }
+            
+            dsn = os.environ.get('DATABASE_URL')
+            if not dsn:
+                return {
+                    'statusCode': 500,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'DATABASE_URL не настроен'}),
+                    'isBase64Encoded': False
+                }
+            
+            max_concurrency = body.get('maxConcurrency')
+            max_concurrency = int(max_concurrency) if isinstance(max_concurrency, (int, float)) and max_concurrency > 0 else None
+            
+            t_start = time.time()
+            result = run_job_sections(str(job_id) if job_id else None, dsn, api_key, proxy_url, max_concurrency, bool(body.get('fused')), bool(body.get('stream')))
+            if result.pop('not_found', False):
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Задача не найдена'}),
+                    'isBase64Encoded': False
+                }
+            result['elapsed_sec'] = round(time.time() - t_start, 1)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'job_id': str(job_id) if job_id else None, **result}, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
+        
+        if mode == 'export':
             job_id = body.get('job_id')
+            export_format = 'docx' if body.get('format') == 'docx' else 'markdown'
             if not job_id:
                 return {
                     'statusCode': 400,
@@ -305,28 +1703,147 @@ def handler(event: dict, context) -> dict:
                 }
             
             dsn = os.environ.get('DATABASE_URL')
-            conn = psycopg2.connect(dsn)
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            if not dsn:
+                return {
+                    'statusCode': 500,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'DATABASE_URL не настроен'}),
+                    'isBase64Encoded': False
+                }
             
-            cur.execute("""
-                SELECT id, section_index, section_title, content, ai_score, uniqueness_score, status
-                FROM document_sections
-                WHERE job_id = %s
-                ORDER BY section_index
-            """, (job_id,))
-            sections = cur.fetchall()
+            content_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' if export_format == 'docx' else 'text/markdown; charset=utf-8'
+            filename = f"document-{job_id}.{'docx' if export_format == 'docx' else 'md'}"
             
-            cur.execute("SELECT status FROM document_jobs WHERE id = %s", (job_id,))
-            job = cur.fetchone()
+            with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as out:
+                if not export_document(str(job_id), dsn, export_format, out):
+                    return {
+                        'statusCode': 404,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Задача не найдена'}),
+                        'isBase64Encoded': False
+                    }
+                size = out.tell()
+                out.seek(0)
+                
+                if size > EXPORT_INLINE_MAX_BYTES:
+                    s3, bucket = _get_s3()
+                    if not s3:
+                        return {
+                            'statusCode': 413,
+                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                            'body': json.dumps({'error': 'Документ слишком большой. Настройте S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY'}),
+                            'isBase64Encoded': False
+                        }
+                    key = f'documents/{job_id}/{uuid.uuid4().hex}/{filename}'
+                    s3.upload_fileobj(out, bucket, key, ExtraArgs={'ContentType': content_type})
+                    url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=86400)
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'url': url, 'size': size, 'format': export_format}),
+                        'isBase64Encoded': False
+                    }
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {
+                        'Content-Type': content_type,
+                        'Content-Disposition': f'attachment; filename="{filename}"',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': base64.b64encode(out.read()).decode('ascii'),
+                    'isBase64Encoded': True
+                }
+        
+        if mode == 'get_status':
+            job_id = body.get('job_id')
+            if not job_id:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'job_id не указан'}),
+                    'isBase64Encoded': False
+                }
+            
+            # since - курсор из прошлого ответа: отдаём только изменившиеся разделы.
+            # Окно STATUS_CURSOR_OVERLAP_SEC до курсора отдаётся повторно - клиент заменяет разделы по id
+            since = body.get('since')
+            since_at = None
+            if since:
+                try:
+                    since_at = datetime.fromisoformat(since)
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Неверный курсор since'}),
+                        'isBase64Encoded': False
+                    }
+            with_content = body.get('withContent', True) is not False
+            
+            dsn = os.environ.get('DATABASE_URL')
+            conn = get_db_connection(dsn)
+            try:
+                cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            
+                # Счётчики считаем в БД, не вытаскивая content
+                cur.execute(f"""
+                    SELECT COUNT(*) AS total,
+                           COUNT(*) FILTER (WHERE status = 'completed') AS completed,
+                           COUNT(*) FILTER (WHERE {_SECTION_LIVE_SQL}) AS live,
+                           MAX(updated_at) AS cursor
+                    FROM document_sections
+                    WHERE job_id = %s
+                """, (SECTION_MAX_ATTEMPTS, job_id))
+                counts = cur.fetchone()
             
-            conn.close()
+                columns = 'id, section_index, section_title, ai_score, uniqueness_score, status, updated_at'
+                if with_content:
+                    columns += ', content'
+                if since_at:
+                    cur.execute(f"""
+                        SELECT {columns}
+                        FROM document_sections
+                        WHERE job_id = %s AND updated_at > %s::timestamp - %s * INTERVAL '1 second'
+                        ORDER BY section_index
+                    """, (job_id, since_at, STATUS_CURSOR_OVERLAP_SEC))
+                else:
+                    cur.execute(f"""
+                        SELECT {columns}
+                        FROM document_sections
+                        WHERE job_id = %s
+                        ORDER BY section_index
+                    """, (job_id,))
+                sections = cur.fetchall()
+            finally:
+                release_db_connection(conn)
             
-            completed = sum(1 for s in sections if s['status'] == 'completed')
-            total = len(sections)
+            completed = counts['completed']
+            total = counts['total']
             
             job_status = 'processing'
             if completed == total:
                 job_status = 'completed'
+            elif counts['live'] == 0:
+                # Оставшиеся разделы исчерпали попытки - дальше опрашивать бессмысленно
+                job_status = 'error'
+            
+            cursor = counts['cursor'].isoformat() if counts['cursor'] else since
+            
+            section_items = []
+            for s in sections:
+                item = {
+                    'id': str(s['id']),
+                    'index': s['section_index'],
+                    'title': s['section_title'],
+                    'ai_score': s['ai_score'],
+                    'uniqueness_score': s['uniqueness_score'],
+                    'status': s['status'],
+                    'updated_at': s['updated_at'].isoformat() if s['updated_at'] else None
+                }
+                if with_content:
+                    item['content'] = s['content']
+                section_items.append(item)
             
             return {
                 'statusCode': 200,
@@ -335,66 +1852,97 @@ def handler(event: dict, context) -> dict:
                     'job_status': job_status,
                     'completed': completed,
                     'total': total,
-                    'sections': [{
-                        'id': str(s['id']),
-                        'index': s['section_index'],
-                        'title': s['section_title'],
-                        'content': s['content'],
-                        'ai_score': s['ai_score'],
-                        'uniqueness_score': s['uniqueness_score'],
-                        'status': s['status']
-                    } for s in sections]
+                    'cursor': cursor,
+                    'sections': section_items
                 }, ensure_ascii=False),
                 'isBase64Encoded': False
             }
         
         if mode == 'section':
-            words_per_page = 300
-            total_words_needed = pages * words_per_page
-            sections_count = len(topics) if topics else 5
-            words_for_intro_conclusion = 400
-            words_for_sections = total_words_needed - words_for_intro_conclusion
-            words_per_section = words_for_sections // sections_count if sections_count > 0 else 500
+            prompt = build_section_prompt(doc_type, subject, pages, topics, section_title, section_description, additional_info)
+
+            fused = bool(body.get('fused'))
+            usage = {}
+            t_start = time.time()
+            
+            # Длинный раздел: части по общему плану пишутся параллельно и сшиваются связками
+            if body.get('chunked', True) is not False and section_target_words(pages, topics, section_title) > SECTION_CHUNK_WORDS:
+                result = generate_chunked_section(doc_type, subject, pages, topics, section_title, section_description, additional_info, api_key, proxy_url, usage)
+                quality = None
+                if result['ai_score'] is not None:
+                    quality = {
+                        'ai_score': result['ai_score'],
+                        'uniqueness_score': result['uniqueness_score'],
+                        'attempts': 1,
+                        'passed': passes_quality(result, settings)
+                    }
+                response_body = {
+                    'text': result['text'],
+                    'metrics': {
+                        'path': 'chunked',
+                        'elapsed_sec': round(time.time() - t_start, 1),
+                        'target_words': result['target_words'],
+                        'words': result['words'],
+                        'usage': usage
+                    }
+                }
+                if quality:
+                    response_body['quality'] = quality
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps(response_body, ensure_ascii=False),
+                    'isBase64Encoded': False
+                }
             
-            target_words = words_per_section
-            if 'введение' in section_title.lower() or 'заключение' in section_title.lower():
-                target_words = 200
+            # Цикл качества на сервере: кандидаты генерируются и оцениваются параллельно
+            if settings['max_attempts'] > 1 and body.get('serverQuality', True) is not False:
+                result = run_quality_loop(prompt, quality_level, api_key, proxy_url, fused, usage)
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'text': result['text'],
+                        'quality': {
+                            'ai_score': result['ai_score'],
+                            'uniqueness_score': result['uniqueness_score'],
+                            'attempts': result['attempts'],
+                            'passed': result['passed']
+                        },
+                        'metrics': {'path': f"best_of_n/{result['path']}", 'elapsed_sec': round(time.time() - t_start, 1), 'usage': usage}
+                    }, ensure_ascii=False),
+                    'isBase64Encoded': False
+                }
             
-            # КРИТИЧНО: Ограничиваем до 600 слов max, чтобы успеть за 25 секунд
-            target_words = min(target_words, 600)
+            # Один запрос: текст и самооценка в структурированном ответе. Двухшаговый путь - только если ответ не разобрался
+            if fused:
+                try:
+                    fused_result = generate_section_fused(prompt, api_key, proxy_url, usage)
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({
+                            'text': humanize_text(fused_result['text']),
+                            'quality': {
+                                'ai_score': fused_result['ai_score'],
+                                'uniqueness_score': fused_result['uniqueness_score'],
+                                'attempts': 1,
+                                'passed': True
+                            },
+                            'metrics': {'path': 'fused', 'elapsed_sec': round(time.time() - t_start, 1), 'usage': usage}
+                        }, ensure_ascii=False),
+                        'isBase64Encoded': False
+                    }
+                except ValueError as e:
+                    print(f"Fused section parse failed, falling back to two calls: {e}")
             
-            prompt = f"""Ты студент, который пишет {doc_type} на тему: {subject}
-
-РАЗДЕЛ: {section_title}
-О ЧЕМ ПИСАТЬ: {section_description}
-
-ТРЕБОВАНИЯ К ОБЪЕМУ:
-- Ровно {target_words} слов (не меньше!)
-
-КАК ПИСАТЬ (КРИТИЧНО ВАЖНО):
-1. Пиши ПРОСТЫМ языком, как объясняешь другу
-2. КОРОТКИЕ и ДЛИННЫЕ предложения вперемешку
-3. Используй АКТИВНЫЙ залог
-4. Приводи КОНКРЕТНЫЕ примеры, цифры, факты
-5. НЕ используй штампы: "в современном мире", "важно отметить", "следует подчеркнуть"
-6. Начни с КОНКРЕТНОГО факта или примера
-7. Добавь ЛИЧНЫЕ наблюдения: "на практике видно...", "интересно, что..."
-8. Используй риторические вопросы иногда
-9. Пиши так, чтобы было интересно читать
-
-{f"ДОПОЛНИТЕЛЬНО: {additional_info}" if additional_info else ''}
-
-ВАЖНО: 
-- Текст должен звучать как написал человек, а не робот
-- {target_words} слов - строго!
-- Напиши ТОЛЬКО текст раздела без заголовка"""
-
-            result_text = generate_with_gemini(prompt, api_key, proxy_url)
+            path = 'fused_fallback' if fused else 'two_call'
+            result_text = generate_with_gemini(prompt, api_key, proxy_url, usage)
             result_text = humanize_text(result_text)
             
             # Проверяем качество УЖЕ сгенерированного текста
             try:
-                scores = check_content_quality(result_text, api_key, proxy_url)
+                scores = check_content_quality(result_text, api_key, proxy_url, usage)
                 ai_score = scores.get('ai_score', 50)
                 uniqueness_score = scores.get('uniqueness_score', 50)
                 
@@ -408,7 +1956,8 @@ def handler(event: dict, context) -> dict:
                             'uniqueness_score': uniqueness_score,
                             'attempts': 1,
                             'passed': True
-                        }
+                        },
+                        'metrics': {'path': path, 'elapsed_sec': round(time.time() - t_start, 1), 'usage': usage}
                     }, ensure_ascii=False),
                     'isBase64Encoded': False
                 }
@@ -418,7 +1967,10 @@ def handler(event: dict, context) -> dict:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'text': result_text}, ensure_ascii=False),
+                    'body': json.dumps({
+                        'text': result_text,
+                        'metrics': {'path': path, 'elapsed_sec': round(time.time() - t_start, 1), 'usage': usage}
+                    }, ensure_ascii=False),
                     'isBase64Encoded': False
                 }
         
@@ -432,18 +1984,29 @@ def handler(event: dict, context) -> dict:
                     'isBase64Encoded': False
                 }
             
+            prescore = body.get('prescore', True) is not False
+            band = body.get('prescoreBand')
+            band = (band[0], band[1]) if isinstance(band, list) and len(band) == 2 else None
+            
             try:
-                scores = check_content_quality(text, api_key, proxy_url)
+                scores = check_content_quality(text, api_key, proxy_url, prescore=prescore, band=band)
                 ai_score = scores.get('ai_score', 50)
                 uniqueness_score = scores.get('uniqueness_score', 50)
+                result = {
+                    'ai_score': ai_score,
+                    'uniqueness_score': uniqueness_score,
+                    'source': scores.get('source', 'gemini'),
+                    'cached': scores.get('cached', False),
+                    'prescore': prescore_stats(),
+                    'parse': parse_stats()
+                }
+                if body.get('chunkScores') is True and scores.get('chunks'):
+                    result['chunks'] = scores['chunks']
                 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'ai_score': ai_score,
-                        'uniqueness_score': uniqueness_score
-                    }, ensure_ascii=False),
+                    'body': json.dumps(result, ensure_ascii=False),
                     'isBase64Encoded': False
                 }
             except Exception as e:
@@ -455,6 +2018,25 @@ def handler(event: dict, context) -> dict:
                 }
         
         if mode == 'topics':
+            dsn = os.environ.get('DATABASE_URL')
+            fresh = body.get('fresh') is True or str(body.get('fresh')).lower() == 'true'
+            cache_key = outline_cache_key(doc_type, subject, pages, additional_info)
+            
+            if fresh:
+                _count_outline_cache('bypass')
+            else:
+                cached_topics, cache_status = outline_cache_get(cache_key, dsn)
+                if cached_topics is not None:
+                    return {
+                        'statusCode': 200,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({
+                            'topics': cached_topics,
+                            'cache': {'status': cache_status, 'stats': outline_cache_stats()}
+                        }, ensure_ascii=False),
+                        'isBase64Encoded': False
+                    }
+            
             sections_count = max(3, pages // 3)
             prompt = f"""Создай структуру для документа типа "{doc_type}" на тему: {subject}
 
@@ -475,19 +2057,26 @@ def handler(event: dict, context) -> dict:
 
 ВАЖНО: Верни ТОЛЬКО JSON, без дополнительного текста, markdown или комментариев!"""
 
-            result_text = generate_with_gemini(prompt, api_key, proxy_url)
-            
-            if result_text.startswith('```'):
-                lines = result_text.split('\n')
-                result_text = '\n'.join(lines[1:-1]) if len(lines) > 2 else result_text
-                result_text = result_text.replace('```json', '').replace('```', '').strip()
-            
-            topics_result = json.loads(result_text)
+            result_text = generate_with_gemini(prompt, api_key, proxy_url, schema=TOPICS_SCHEMA)
+            try:
+                topics_result = parse_structured(result_text, TOPICS_SCHEMA, 'topics')
+            except ValueError as e:
+                return {
+                    'statusCode': 502,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': f'Некорректная структура от модели: {str(e)}'}, ensure_ascii=False),
+                    'isBase64Encoded': False
+                }
+            outline_cache_put(cache_key, topics_result, dsn)
             
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'topics': topics_result}, ensure_ascii=False),
+                'body': json.dumps({
+                    'topics': topics_result,
+                    'cache': {'status': 'bypass' if fresh else 'miss', 'stats': outline_cache_stats()},
+                    'parse': parse_stats()
+                }, ensure_ascii=False),
                 'isBase64Encoded': False
             }
             
@@ -0,0 +1,64 @@
+"""
+Тесты воркера очереди разделов: передача оставшейся работы новому вызову после дедлайна.
+БД и генерация подменяются, сеть не нужна.
+
+    python -m unittest backend/doc-writer/test_run_job_sections.py
+"""
+
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import index  # noqa: E402
+
+JOB_ID = '00000000-0000-0000-0000-000000000001'
+JOB = {
+    'id': JOB_ID, 'doc_type': 'реферат', 'subject': 'Тест', 'pages': 1,
+    'topics': [{'title': 'Раздел'}], 'additional_info': '', 'quality_level': 'standard',
+}
+
+def section(n: int) -> dict:
+    return {'id': f'00000000-0000-0000-0000-00000000010{n}', 'job_id': JOB_ID, 'section_title': 'Раздел', 'section_description': ''}
+
+def slow_generation(*args, **kwargs) -> dict:
+    time.sleep(0.3)
+    return {'text': 'текст', 'ai_score': 10, 'uniqueness_score': 90}
+
+class RunJobSectionsDeadlineTest(unittest.TestCase):
+    def run_worker(self, claims: list, leftover: bool):
+        cur = mock.MagicMock()
+        cur.fetchone.return_value = {'?column?': 1}
+        cur.fetchall.return_value = [JOB]
+        conn = mock.MagicMock()
+        conn.cursor.return_value = cur
+        with mock.patch.object(index, 'get_db_connection', return_value=conn), \
+                mock.patch.object(index, 'release_db_connection'), \
+                mock.patch.object(index, 'WORKER_MAX_RUN_SEC', 0.1), \
+                mock.patch.object(index, 'section_target_words', return_value=0), \
+                mock.patch.object(index, 'run_quality_loop', side_effect=slow_generation), \
+                mock.patch.object(index, '_claim_sections', side_effect=claims + [[]] * 10) as claim, \
+                mock.patch.object(index, '_has_claimable_sections', return_value=leftover) as has_claimable, \
+                mock.patch.object(index, 'trigger_job_worker') as trigger:
+            result = index.run_job_sections(JOB_ID, 'dsn', 'key', max_concurrency=1)
+        return result, claim, has_claimable, trigger
+
+    def test_leftover_sections_trigger_next_worker(self):
+        result, claim, has_claimable, trigger = self.run_worker([[section(1)]], leftover=True)
+        self.assertEqual(result['completed'], 1)
+        # Раздел закончился после дедлайна - больше ничего не забираем
+        self.assertEqual(claim.call_count, 1)
+        has_claimable.assert_called_once()
+        trigger.assert_called_once_with(JOB_ID, False)
+
+    def test_no_trigger_when_job_is_done(self):
+        result, _, has_claimable, trigger = self.run_worker([[section(1)]], leftover=False)
+        self.assertEqual(result['completed'], 1)
+        has_claimable.assert_called_once()
+        trigger.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
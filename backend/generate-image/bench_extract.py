@@ -0,0 +1,121 @@
+"""
+Бенчмарк памяти: извлечение картинки из ответа Gemini целиком (json.loads всего тела) против потокового разбора.
+Тело ответа читается из файла, как из сокета; каждый замер - отдельный процесс, пик RSS по ru_maxrss.
+Проверяет совпадение результата и печатает пиковый прирост RSS на одну картинку.
+
+    python backend/generate-image/bench_extract.py [--image-mb 8] [--repeat 3]
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from index import inline_mime_type, make_image_sink, stream_extract_inline_data  # noqa: E402
+
+def extract_reference(body_file, output: str) -> tuple:
+    '''Прежний путь: json.loads всего тела, base64 из dict - эталон для сравнения'''
+    gemini_response = json.loads(body_file.read().decode('utf-8'))
+    for part in gemini_response['candidates'][0]['content']['parts']:
+        inline = part.get('inlineData') or part.get('inline_data')
+        if inline and inline.get('data'):
+            mime_type = inline.get('mimeType') or 'image/png'
+            if output == 's3':
+                return base64.b64decode(inline['data']), mime_type
+            return json.dumps({'imageUrl': f"data:{mime_type};base64,{inline['data']}"}), mime_type
+    return None, None
+
+def extract_streaming(body_file, output: str) -> tuple:
+    '''Новый путь: потоковый разбор, base64 сразу в приёмник'''
+    write, result = make_image_sink(output != 's3')
+    gemini_response = stream_extract_inline_data(body_file, write)
+    payload = result()
+    mime_type = inline_mime_type(gemini_response)
+    if output == 's3':
+        return payload, mime_type
+    return json.dumps({'imageUrl': f'data:{mime_type};base64,{payload}'}), mime_type
+
+def make_body(path: str, image_mb: float, seed: int):
+    '''Синтетический ответ Gemini: текстовая часть и картинка image_mb МБ (случайные байты - base64 не сожмётся)'''
+    image = random.Random(seed).randbytes(int(image_mb * 1024 * 1024))
+    body = {
+        'candidates': [{
+            'content': {'parts': [
+                {'text': 'Вот изображение по вашему запросу.'},
+                {'inlineData': {'mimeType': 'image/png', 'data': base64.b64encode(image).decode()}},
+            ], 'role': 'model'},
+            'finishReason': 'STOP',
+        }],
+        'usageMetadata': {'promptTokenCount': 12, 'candidatesTokenCount': 1290},
+        'modelVersion': 'gemini-2.5-flash-image',
+    }
+    with open(path, 'w') as f:
+        json.dump(body, f)
+
+def peak_rss_kb() -> int:
+    '''Пик RSS процесса в КБ: VmHWM (сбрасывается при exec), иначе ru_maxrss - он наследуется от родителя'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def worker(path_name: str, output: str, body_path: str):
+    '''Один замер в чистом процессе: прирост пика RSS (КБ) и хэш результата'''
+    fn = extract_reference if path_name == 'reference' else extract_streaming
+    before = peak_rss_kb()
+    with open(body_path, 'rb') as f:
+        payload, mime_type = fn(f, output)
+    peak = peak_rss_kb()
+    data = payload.encode() if isinstance(payload, str) else payload
+    print(json.dumps({'peakKb': peak - before, 'sha': hashlib.sha256(data).hexdigest(), 'mime': mime_type}))
+
+def measure(path_name: str, output: str, body_path: str, repeat: int) -> dict:
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', path_name, output, body_path],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {'peakKb': min(r['peakKb'] for r in runs), 'sha': runs[0]['sha'], 'mime': runs[0]['mime']}
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        worker(*sys.argv[2:5])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image-mb', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        body_path = os.path.join(tmp, 'response.json')
+        make_body(body_path, args.image_mb, args.seed)
+        body_mb = os.path.getsize(body_path) / 1024 / 1024
+        print(f'response={body_mb:.1f} MB (image {args.image_mb:g} MB), best of {args.repeat}, peak RSS growth per image')
+        for output in ('s3', 'dataUrl'):
+            ref = measure('reference', output, body_path, args.repeat)
+            new = measure('streaming', output, body_path, args.repeat)
+            if (ref['sha'], ref['mime']) != (new['sha'], new['mime']):
+                print(f'MISMATCH: output={output} results differ')
+                sys.exit(1)
+            print(f'{output:8}  reference : {ref["peakKb"] / 1024:7.1f} MB')
+            print(f'{output:8}  streaming : {new["peakKb"] / 1024:7.1f} MB  (x{ref["peakKb"] / max(new["peakKb"], 1):.1f} less)')
+        print('outputs identical')
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,607 @@ import time
 import urllib.request
 import urllib.error
 import base64
+import binascii
+import hashlib
+import hmac
+import io
+import re
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MAX_RETRIES = 3
 RETRY_DELAY_SEC = 4
 RETRY_CODES = (503, 429, 500)
 
+# output: 's3' - картинка кладётся в S3 по ключу из sha256 содержимого, в ответе presigned URL и миниатюра
+IMAGE_URL_TTL_SEC = 86400
+THUMBNAIL_SIZE = 256
+IMAGE_EXT = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+# Кэш результатов: sha256 нормализованного запроса (+ хэш байтов образца) -> метаданные в images/cache/<key>.json,
+# сама картинка - в images/<sha256>. variation: true - сгенерировать заново мимо кэша
+IMAGE_CACHE_TTL_SEC = int(os.environ.get('IMAGE_CACHE_TTL_SEC', str(7 * 24 * 3600)))
+IMAGE_CACHE_VERSION = 1
+
+# Yandex ART: постановка и опрос раздельно (как в generate-video), функция не спит в ожидании.
+# Интервал опроса подстраивается под медиану наблюдаемого времени готовности
+ART_DEFAULT_DURATION_SEC = 20
+ART_MIN_SAMPLES = 5
+ART_POLL_MIN_SEC = 1.5
+ART_POLL_MAX_SEC = 10
+ART_MAX_WAIT_SEC = 300
+_art_durations = deque(maxlen=50)
+_art_lock = threading.Lock()
+
+# Предобработка образца: модели не нужны 12 МП с телефона - уменьшаем, убираем EXIF, пережимаем.
+# Результат кэшируется в памяти по sha256 исходника
+REF_MAX_SIDE = int(os.environ.get('REF_MAX_SIDE', '1536'))
+REF_JPEG_QUALITY = 85
+REF_CACHE_SIZE = 32
+_ref_cache = OrderedDict()
+_ref_lock = threading.Lock()
+
+# count: несколько вариантов за запрос - параллельные вызовы модели
+IMAGE_MAX_COUNT = 4
+IMAGE_VARIANT_CONCURRENCY = int(os.environ.get('IMAGE_VARIANT_CONCURRENCY', '4'))
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
+def _get_s3():
+    '''Клиент S3 создаётся один раз на тёплый контейнер: boto3-клиент потокобезопасен, а его сборка - десятки мс'''
+    global _s3_client
+    bucket = os.environ.get('S3_BUCKET')
+    key_id = os.environ.get('S3_ACCESS_KEY')
+    secret = os.environ.get('S3_SECRET_KEY')
+    if not (bucket and key_id and secret):
+        return None, None
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url='https://storage.yandexcloud.net',
+                    aws_access_key_id=key_id,
+                    aws_secret_access_key=secret,
+                )
+    return _s3_client, bucket
+
+def _make_thumbnail(image_bytes: bytes) -> bytes:
+    '''JPEG-миниатюра до THUMBNAIL_SIZE по большей стороне, None - Pillow недоступен или картинка не читается'''
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            out = io.BytesIO()
+            img.convert('RGB').save(out, format='JPEG', quality=75, optimize=True)
+            return out.getvalue()
+    except Exception as e:
+        print(f'[generate_image] thumbnail skipped: {e}')
+        return None
+
+class ReferenceImageError(ValueError):
+    '''Образец не читается: испорченный base64 или не изображение'''
+
+# Служебные поля Pillow, которые не несут сведений о съёмке/авторе (EXIF, GPS, XMP, комментарии - несут)
+_REF_PLAIN_INFO = {
+    'dpi', 'jfif', 'jfif_version', 'jfif_unit', 'jfif_density', 'progressive', 'progression',
+    'adobe', 'adobe_transform', 'transparency', 'gamma', 'interlace', 'aspect', 'srgb', 'icc_profile',
+    'duration', 'loop', 'background', 'version', 'compression',
+}
+
+def preprocess_reference(ref_b64: str, ref_mime: str) -> tuple:
+    '''Готовит образец к отправке: поворот по EXIF, уменьшение до REF_MAX_SIDE, без метаданных,
+    JPEG (PNG при прозрачности). Результат кэшируется по sha256 исходника.
+    Возвращает (base64, mimeType, отчёт). ReferenceImageError - образец не читается. Без Pillow - исходник как есть'''
+    try:
+        raw = base64.b64decode(ref_b64)
+    except (binascii.Error, ValueError, TypeError):
+        raise ReferenceImageError('Образец изображения повреждён: неверный base64')
+    if not raw:
+        raise ReferenceImageError('Образец изображения пуст')
+    digest = hashlib.sha256(raw).hexdigest()
+    report = {'originalBytes': len(raw), 'bytes': len(raw), 'savedPct': 0, 'cached': False}
+    with _ref_lock:
+        hit = _ref_cache.get(digest)
+        if hit:
+            _ref_cache.move_to_end(digest)
+    if hit:
+        data, mime = hit
+        report.update({'bytes': len(data), 'savedPct': round(100 * (1 - len(data) / len(raw))), 'cached': True})
+        return base64.b64encode(data).decode(), mime, report
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print('[reference] Pillow not installed, sending as is')
+        return ref_b64, ref_mime, report
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+    except Exception as e:
+        # UnidentifiedImageError, DecompressionBombError, обрезанный файл
+        print(f'[reference] decode failed: {e}')
+        raise ReferenceImageError('Не удалось прочитать образец изображения')
+    with img:
+        has_metadata = bool(img.getexif()) or any(key not in _REF_PLAIN_INFO for key in img.info)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((REF_MAX_SIDE, REF_MAX_SIDE))
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img.save(out, format='PNG', optimize=True)
+            mime = 'image/png'
+        else:
+            img.convert('RGB').save(out, format='JPEG', quality=REF_JPEG_QUALITY, optimize=True)
+            mime = 'image/jpeg'
+    data = out.getvalue()
+    if len(data) >= len(raw) and not has_metadata:
+        # Уже компактный исходник без метаданных - оставляем как есть.
+        # С метаданными (EXIF, GPS) отправляем перекодированный, даже если он чуть больше
+        data, mime = raw, ref_mime
+    with _ref_lock:
+        _ref_cache[digest] = (data, mime)
+        while len(_ref_cache) > REF_CACHE_SIZE:
+            _ref_cache.popitem(last=False)
+    report.update({'bytes': len(data), 'savedPct': round(100 * (1 - len(data) / len(raw)))})
+    return base64.b64encode(data).decode(), mime, report
+
+def store_image(image_bytes: bytes, mime_type: str) -> dict:
+    '''Кладёт картинку в S3 под ключом images/<sha256>.<ext> (повтор не загружается) и миниатюру рядом.
+    Возвращает поля ответа: imageUrl/thumbnailUrl - presigned URL на сутки'''
+    s3, bucket = _get_s3()
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    key = f'images/{digest}.{IMAGE_EXT.get(mime_type, "png")}'
+    thumb_key = f'images/{digest}_thumb.jpg'
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        has_thumb = True
+        try:
+            s3.head_object(Bucket=bucket, Key=thumb_key)
+        except Exception:
+            has_thumb = False
+    except Exception:
+        s3.put_object(Bucket=bucket, Key=key, Body=image_bytes, ContentType=mime_type)
+        thumb = _make_thumbnail(image_bytes)
+        has_thumb = thumb is not None
+        if has_thumb:
+            s3.put_object(Bucket=bucket, Key=thumb_key, Body=thumb, ContentType='image/jpeg')
+    result = {
+        'imageUrl': s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=IMAGE_URL_TTL_SEC),
+        'imageKey': key,
+        'bytes': len(image_bytes)
+    }
+    if has_thumb:
+        result['thumbnailUrl'] = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': thumb_key}, ExpiresIn=IMAGE_URL_TTL_SEC)
+    return result
+
+def image_cache_key(task: str, style: str, aspect_ratio: str, image_model: str, provider: str, ref_b64: str = None) -> str:
+    '''Ключ кэша: нормализованные параметры запроса и sha256 байтов образца'''
+    ref_hash = hashlib.sha256(base64.b64decode(ref_b64)).hexdigest() if ref_b64 else None
+    normalized = {
+        'v': IMAGE_CACHE_VERSION,
+        'task': ' '.join(task.split()).lower(),
+        'style': style,
+        'aspectRatio': aspect_ratio,
+        'imageModel': image_model if provider != 'yandex' else None,
+        'provider': provider,
+        'ref': ref_hash
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def image_cache_get(cache_key: str, output: str) -> dict:
+    '''Поля ответа из кэша (как у store_image или data URL), None - промах или запись устарела'''
+    s3, bucket = _get_s3()
+    try:
+        r = s3.get_object(Bucket=bucket, Key=f'images/cache/{cache_key}.json')
+        meta = json.loads(r['Body'].read().decode())
+    except Exception:
+        return None
+    if time.time() - meta.get('createdAt', 0) > IMAGE_CACHE_TTL_SEC:
+        return None
+    key = meta['imageKey']
+    if output != 's3':
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except Exception:
+            return None
+        return {'imageUrl': f"data:{meta.get('mimeType', 'image/png')};base64,{base64.b64encode(body).decode()}", 'prompt': meta.get('prompt')}
+    result = {
+        'imageUrl': s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=IMAGE_URL_TTL_SEC),
+        'imageKey': key,
+        'bytes': meta.get('bytes'),
+        'prompt': meta.get('prompt')
+    }
+    if meta.get('thumbnailKey'):
+        result['thumbnailUrl'] = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': meta['thumbnailKey']}, ExpiresIn=IMAGE_URL_TTL_SEC)
+    return result
+
+def image_cache_put(cache_key: str, stored: dict, mime_type: str, prompt: str):
+    '''Записывает метаданные результата в индекс кэша'''
+    s3, bucket = _get_s3()
+    meta = {
+        'imageKey': stored['imageKey'],
+        'thumbnailKey': stored['imageKey'].rsplit('.', 1)[0] + '_thumb.jpg' if stored.get('thumbnailUrl') else None,
+        'mimeType': mime_type,
+        'bytes': stored.get('bytes'),
+        'prompt': prompt,
+        'createdAt': time.time()
+    }
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=f'images/cache/{cache_key}.json',
+            Body=json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json',
+        )
+    except Exception as e:
+        print(f'[generate_image] cache write failed: {e}')
+
+def _cache_image_in_background(cache_key: str, image_b64: str, image_bytes: bytes, mime_type: str, prompt: str):
+    '''Загрузка в S3 и запись индекса кэша вне пути ответа. Если контейнер заморозят сразу после ответа,
+    запись доедет при следующем тёплом вызове или потеряется - кэш от этого только промахнётся'''
+    try:
+        stored = store_image(image_bytes if image_bytes is not None else base64.b64decode(image_b64), mime_type)
+        image_cache_put(cache_key, stored, mime_type, prompt)
+    except Exception as e:
+        print(f'[generate_image] cache write failed: {e}')
+
+def image_response_fields(image_b64: str, mime_type: str, output: str, cache_key: str = None, prompt: str = None,
+                          image_bytes: bytes = None) -> dict:
+    '''Поля ответа с картинкой: data URL или presigned URL; при cache_key результат попадает в кэш.
+    Картинка - base64 (image_b64) или уже декодированные байты (image_bytes)'''
+    if output == 's3':
+        stored = store_image(image_bytes if image_bytes is not None else base64.b64decode(image_b64), mime_type)
+        if cache_key:
+            image_cache_put(cache_key, stored, mime_type, prompt)
+        return stored
+    if cache_key:
+        # Для data URL запись в кэш - побочная: идёт в фоне, ответ её не ждёт
+        threading.Thread(
+            target=_cache_image_in_background,
+            args=(cache_key, image_b64, image_bytes, mime_type, prompt),
+            daemon=True
+        ).start()
+    if image_b64 is None:
+        image_b64 = base64.b64encode(image_bytes).decode()
+    return {'imageUrl': f"data:{mime_type};base64,{image_b64}"}
+
+def _yandex_urlopen(req, timeout: int = 30) -> dict:
+    proxy_url = os.environ.get('PROXY_URL')
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+def submit_yandex_art(prompt: str, width_ratio: str, height_ratio: str, variant: int = 0) -> str:
+    '''Ставит генерацию в Yandex ART и сразу возвращает id операции. variant сдвигает seed.
+    Exception - ошибка API'''
+    yandex_api_key = os.environ.get('YANDEX_API_KEY')
+    yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
+    art_body = {
+        'modelUri': f'art://{yandex_folder_id}/yandex-art/latest',
+        'messages': [{'text': prompt}],
+        'generationOptions': {
+            'seed': str(((hash(prompt) + variant) % 10**9) + 10**9),
+            'aspectRatio': {'widthRatio': width_ratio, 'heightRatio': height_ratio}
+        }
+    }
+    req = urllib.request.Request(
+        'https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync',
+        data=json.dumps(art_body).encode('utf-8'),
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Api-Key {yandex_api_key}'
+        }
+    )
+    try:
+        op_data = _yandex_urlopen(req)
+    except urllib.error.HTTPError as e:
+        err_b = e.read().decode('utf-8') if e.fp else ''
+        raise Exception(f'Yandex ART: {e.code} {err_b[:400]}')
+    op_id = op_data.get('id')
+    if not op_id:
+        raise Exception(f'Yandex ART не вернул id операции: {str(op_data)[:300]}')
+    return op_id
+
+def check_yandex_operation(op_id: str) -> dict:
+    '''Одна проверка операции Yandex ART (без ожидания)'''
+    req = urllib.request.Request(
+        f'https://operation.api.cloud.yandex.net/operations/{op_id}',
+        headers={'Authorization': f"Api-Key {os.environ.get('YANDEX_API_KEY')}"}
+    )
+    try:
+        return _yandex_urlopen(req)
+    except urllib.error.HTTPError as e:
+        raise Exception(f'Yandex операция: {e.code}')
+
+def _operation_secret() -> bytes:
+    '''Ключ подписи handle: OPERATION_SIGNING_KEY, иначе производный от YANDEX_API_KEY (известен только серверу)'''
+    secret = os.environ.get('OPERATION_SIGNING_KEY')
+    if secret:
+        return secret.encode()
+    return hashlib.sha256(f"generate-image-operation\n{os.environ.get('YANDEX_API_KEY', '')}".encode()).digest()
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def encode_operation(op_id: str, cache_key: str, output: str) -> str:
+    '''Handle операции для клиента: id, время постановки и куда сохранить результат, подписанные HMAC -
+    клиент не может подменить ключ кэша или время постановки'''
+    payload = _b64url(json.dumps({'id': op_id, 't': round(time.time(), 1), 'k': cache_key, 'o': output}).encode())
+    signature = _b64url(hmac.new(_operation_secret(), payload.encode(), hashlib.sha256).digest())
+    return f'{payload}.{signature}'
+
+def decode_operation(handle: str) -> dict:
+    '''Проверяет подпись и разбирает handle. ValueError - handle испорчен или подделан'''
+    payload, _, signature = handle.partition('.')
+    expected = _b64url(hmac.new(_operation_secret(), payload.encode(), hashlib.sha256).digest())
+    if not signature or not hmac.compare_digest(signature.encode(), expected.encode()):
+        raise ValueError('Неверный operation')
+    try:
+        op = json.loads(base64.urlsafe_b64decode((payload + '=' * (-len(payload) % 4)).encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Неверный operation')
+    if not isinstance(op, dict) or not isinstance(op.get('id'), str) or not isinstance(op.get('t'), (int, float)):
+        raise ValueError('Неверный operation')
+    return op
+
+def record_art_duration(seconds: float):
+    with _art_lock:
+        _art_durations.append(seconds)
+
+def next_poll_delay(elapsed: float) -> float:
+    '''Через сколько секунд опрашивать снова: до типичного времени готовности - редко
+    (сразу к ожидаемому моменту), после - часто с нарастанием до ART_POLL_MAX_SEC'''
+    with _art_lock:
+        durations = sorted(_art_durations)
+    typical = durations[len(durations) // 2] if len(durations) >= ART_MIN_SAMPLES else ART_DEFAULT_DURATION_SEC
+    if elapsed < typical:
+        return round(max(ART_POLL_MIN_SEC, min(typical - elapsed, typical / 2)), 1)
+    return round(min(ART_POLL_MAX_SEC, ART_POLL_MIN_SEC + (elapsed - typical) / 2), 1)
+
+def poll_yandex_art(handle: str) -> dict:
+    '''Опрос операции по handle: тело ответа с картинкой или {'status': 'processing', 'pollAfterSec': ...}'''
+    op = decode_operation(handle)
+    elapsed = max(0.0, time.time() - op['t'])
+    op_result = check_yandex_operation(op['id'])
+    if not op_result.get('done'):
+        if elapsed > ART_MAX_WAIT_SEC:
+            raise Exception('Yandex ART: генерация заняла слишком много времени. Попробуйте позже.')
+        return {'status': 'processing', 'elapsedSec': round(elapsed, 1), 'pollAfterSec': next_poll_delay(elapsed)}
+    if op_result.get('error'):
+        raise Exception(f"Yandex ART: {op_result['error'].get('message', 'ошибка генерации')}")
+    image_b64_art = (op_result.get('response') or {}).get('image')
+    if not image_b64_art:
+        raise Exception('В ответе Yandex ART нет изображения')
+    record_art_duration(elapsed)
+    return {
+        'status': 'done',
+        **image_response_fields(image_b64_art, 'image/png', op.get('o', 'dataUrl'), op.get('k')),
+        'debug': {'total_sec': round(elapsed, 1), 'provider': 'yandex'}
+    }
+
+_STRUCTURAL_RE = re.compile(rb'["{}\[\]:,]')
+
+def make_image_sink(keep_base64: bool) -> tuple:
+    '''Приёмник base64 картинки: (write, result). keep_base64 - копим текст для data URL,
+    иначе декодируем на лету в байты (для S3/кэша), не держа base64 целиком.
+    Буфер - один bytearray, без списка кусков и лишней копии при сборке'''
+    buf = bytearray()
+    carry = [b'']
+
+    def write(chunk: bytes):
+        if keep_base64:
+            buf.extend(chunk)
+            return
+        data = carry[0] + chunk
+        cut = len(data) - len(data) % 4
+        buf.extend(base64.b64decode(data[:cut]))
+        carry[0] = data[cut:]
+
+    def result():
+        if keep_base64:
+            text = buf.decode('ascii')
+            del buf[:]
+            return text
+        if carry[0]:
+            buf.extend(base64.b64decode(carry[0] + b'=' * (-len(carry[0]) % 4)))
+            carry[0] = b''
+        return buf
+
+    return write, result
+
+def stream_extract_inline_data(stream, on_data, chunk_size: int = 1 << 16) -> dict:
+    '''Разбирает JSON-ответ Gemini потоком: содержимое первого inlineData.data уходит кусками в on_data,
+    остальное собирается в «скелет» (data там пустая строка) и возвращается как dict.
+    Картинка не лежит в памяти ни сырым телом ответа, ни строкой внутри dict'''
+    skeleton = bytearray()
+    stack = []  # по уровню: [тип '{'/'[', текущий ключ, ждём ли ключ]
+    in_string = False
+    escape = False
+    divert = False
+    diverted = False
+    is_key = False
+    key_buf = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if in_string and divert:
+                # base64 без кавычек; экранирование бывает только '\/'
+                j = chunk.find(b'"', i)
+                end = n if j < 0 else j
+                piece = chunk[i:end]
+                escape = False
+                if piece.endswith(b'\\'):
+                    piece = piece[:-1]
+                    escape = True
+                if b'\\' in piece:
+                    piece = piece.replace(b'\\/', b'/')
+                if piece:
+                    on_data(piece)
+                if j < 0:
+                    break
+                skeleton += b'"'
+                in_string = divert = False
+                i = j + 1
+                continue
+            if in_string:
+                # Обычная строка: ищем закрывающую кавычку, учитывая экранирование
+                start = i
+                while i < n:
+                    ch = chunk[i]
+                    if escape:
+                        escape = False
+                    elif ch == 0x5C:
+                        escape = True
+                    elif ch == 0x22:
+                        break
+                    i += 1
+                skeleton += chunk[start:i]
+                if is_key:
+                    key_buf += chunk[start:i]
+                if i < n:
+                    skeleton += b'"'
+                    in_string = False
+                    if is_key:
+                        stack[-1][1] = key_buf.decode('utf-8', 'replace')
+                    i += 1
+                continue
+            m = _STRUCTURAL_RE.search(chunk, i)
+            if not m:
+                skeleton += chunk[i:]
+                break
+            skeleton += chunk[i:m.start()]
+            ch = chunk[m.start():m.start() + 1]
+            i = m.end()
+            skeleton += ch
+            if ch == b'"':
+                in_string = True
+                is_key = bool(stack) and stack[-1][0] == '{' and stack[-1][2]
+                key_buf = bytearray()
+                if (not is_key and not diverted and len(stack) >= 2 and stack[-1][1] == 'data'
+                        and stack[-2][1] in ('inlineData', 'inline_data')):
+                    divert = diverted = True
+            elif ch == b'{':
+                stack.append(['{', None, True])
+            elif ch == b'[':
+                stack.append(['[', None, False])
+            elif ch in (b'}', b']'):
+                stack.pop()
+            elif ch == b':':
+                stack[-1][2] = False
+            elif ch == b',' and stack and stack[-1][0] == '{':
+                stack[-1][2] = True
+    return json.loads(skeleton.decode('utf-8'))
+
+def call_gemini_image(gemini_url: str, gemini_request: dict, on_data=None) -> dict:
+    '''Запрос к Gemini image с повторами на 503/429/500. HTTPError - после последней попытки.
+    С on_data тело читается потоком: base64 картинки уходит в on_data, в ответе вместо него пустая строка'''
+    req = urllib.request.Request(
+        gemini_url,
+        data=json.dumps(gemini_request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+
+    proxy_url = os.environ.get('PROXY_URL')
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            print(f'[generate_image] calling_gemini attempt={attempt + 1}')
+            with urllib.request.urlopen(req, timeout=120) as response:
+                if on_data:
+                    return stream_extract_inline_data(response, on_data)
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            if e.code in RETRY_CODES and attempt < MAX_RETRIES - 1:
+                time.sleep(RETRY_DELAY_SEC * (attempt + 1))
+                continue
+            raise
+
+def inline_mime_type(gemini_response: dict) -> str:
+    '''mimeType первой картинки в ответе Gemini (после потокового разбора data там пустая), None - картинки нет'''
+    candidates = gemini_response.get('candidates') or []
+    if not candidates:
+        return None
+    content = candidates[0].get('content') or {}
+    for part in content.get('parts') or []:
+        # REST может вернуть camelCase (inlineData) или snake_case (inline_data)
+        inline = part.get('inlineData') or part.get('inline_data')
+        if inline is not None:
+            return inline.get('mimeType') or inline.get('mime_type') or 'image/png'
+    return None
+
+def gemini_image_fields(gemini_url: str, gemini_request: dict, output: str, cache_key: str = None, prompt: str = None) -> tuple:
+    '''Генерация в Gemini с потоковым разбором ответа: (поля ответа или None, ответ Gemini без base64).
+    Для S3 и кэша base64 декодируется на лету, для data URL копится текстом - без промежуточного dict'''
+    write, result = make_image_sink(output != 's3' and not cache_key)
+    gemini_response = call_gemini_image(gemini_url, gemini_request, on_data=write)
+    payload = result()
+    mime_type = inline_mime_type(gemini_response)
+    if not payload or not mime_type:
+        return None, gemini_response
+    if isinstance(payload, str):
+        return image_response_fields(payload, mime_type, output), gemini_response
+    return image_response_fields(None, mime_type, output, cache_key, prompt, image_bytes=payload), gemini_response
+
+def _peek(obj, depth=0):
+    '''Структура ответа для отладки (без больших base64)'''
+    if depth > 4:
+        return '...'
+    if isinstance(obj, dict):
+        return {k: _peek(v, depth + 1) if k != 'data' else '<base64>' for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_peek(x, depth + 1) for x in obj[:3]]
+    return type(obj).__name__
+
+def gemini_error_message(e: urllib.error.HTTPError) -> str:
+    '''Понятное пользователю сообщение об ошибке Gemini API'''
+    try:
+        error_body = e.read().decode('utf-8') if e.fp else str(e)
+    except Exception:
+        error_body = str(e)
+    if error_body:
+        try:
+            err = json.loads(error_body)
+            if err.get('error', {}).get('status') == 'UNAVAILABLE' or err.get('error', {}).get('code') == 503:
+                return 'Модель перегружена. Обычно это ненадолго — попробуйте через минуту.'
+            elif err.get('error', {}).get('message'):
+                return err['error']['message'][:200]
+        except Exception:
+            pass
+    if e.code == 503:
+        return 'Сервис Gemini временно недоступен. Попробуйте через минуту.'
+    elif e.code == 429:
+        return 'Слишком много запросов. Подождите немного и попробуйте снова.'
+    return f'Gemini API error: {e.code}'
+
+def generate_variants(count: int, make_variant) -> list:
+    '''count вариантов параллельно (не больше IMAGE_VARIANT_CONCURRENCY запросов).
+    Порядок - по готовности, у каждого index; ошибка варианта не валит остальные'''
+    variants = []
+    with ThreadPoolExecutor(max_workers=min(IMAGE_VARIANT_CONCURRENCY, count)) as pool:
+        futures = {pool.submit(make_variant, i): i for i in range(count)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                variants.append({'index': index, **future.result()})
+            except urllib.error.HTTPError as e:
+                variants.append({'index': index, 'error': gemini_error_message(e)})
+            except Exception as e:
+                variants.append({'index': index, 'error': str(e)})
+    return variants
+
 def handler(event: dict, context) -> dict:
     '''Генерация изображений через Gemini (gemini-2.5-flash-image)'''
 
@@ -19,13 +615,42 @@ def handler(event: dict, context) -> dict:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
 
+    if method == 'GET':
+        handle = (event.get('queryStringParameters') or {}).get('operation')
+        if not handle:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Укажите operation'})
+            }
+        try:
+            decode_operation(handle)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)})
+            }
+        try:
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(poll_yandex_art(handle))
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)})
+            }
+
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -57,6 +682,12 @@ def handler(event: dict, context) -> dict:
         image_model = request_data.get('imageModel', 'flash')  # 'flash' | 'pro'
         image_provider = request_data.get('imageProvider', request_data.get('provider', 'gemini'))  # 'gemini' | 'yandex'
         reference_image = request_data.get('referenceImage')  # optional: base64 string or { "mimeType": "...", "data": "..." }
+        output = request_data.get('output', 'dataUrl')  # 'dataUrl' | 's3'
+        variation = request_data.get('variation') is True  # новый вариант мимо кэша
+        try:
+            count = max(1, min(IMAGE_MAX_COUNT, int(request_data.get('count', 1))))
+        except (TypeError, ValueError):
+            count = 1
 
         if not task:
             return {
@@ -65,6 +696,13 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'Описание изображения не указано'})
             }
 
+        if output == 's3' and not _get_s3()[0]:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Настройте S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY'})
+            }
+
         style_prompts = {
             'как_на_картинке': '',  # используется только при has_reference; стиль берётся с образца
             'фотореализм': 'Photorealistic, ultra-detailed, professional photography, high quality',
@@ -94,6 +732,18 @@ def handler(event: dict, context) -> dict:
                 ref_b64 = reference_image
             if ref_b64:
                 has_reference = True
+        # Образец готовим до ключа кэша: испорченный сразу отклоняем с 400
+        ref_report = None
+        if has_reference:
+            try:
+                ref_b64, ref_mime, ref_report = preprocess_reference(ref_b64, ref_mime)
+            except ReferenceImageError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': str(e)})
+                }
+            print(f'[generate_image] reference {ref_report}')
         if has_reference:
             if use_reference_style:
                 prompt = (
@@ -135,104 +785,58 @@ def handler(event: dict, context) -> dict:
         gemini_aspect = aspect_to_gemini.get(aspect_ratio, '1:1')
         yandex_w, yandex_h = aspect_to_yandex.get(aspect_ratio, ('1', '1'))
 
-        if image_provider == 'yandex':
-            yandex_api_key = os.environ.get('YANDEX_API_KEY')
-            yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
-            proxy_url = os.environ.get('PROXY_URL')
-            if not yandex_api_key or not yandex_folder_id:
+        # Повтор того же запроса отдаём из кэша (нужен S3)
+        cache_key = None
+        if count == 1 and _get_s3()[0]:
+            cache_key = image_cache_key(task, style, aspect_ratio, image_model, image_provider, ref_b64 if has_reference else None)
+            cached = None if variation else image_cache_get(cache_key, output)
+            if cached:
+                print(f'[generate_image] cache hit key={cache_key[:12]}')
                 return {
-                    'statusCode': 500,
+                    'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'YANDEX_API_KEY или YANDEX_FOLDER_ID не настроены'})
-                }
-            model_uri = f'art://{yandex_folder_id}/yandex-art/latest'
-            art_body = {
-                'modelUri': model_uri,
-                'messages': [{'text': prompt}],
-                'generationOptions': {
-                    'seed': str((hash(prompt) % 10**9) + 10**9),
-                    'aspectRatio': {'widthRatio': yandex_w, 'heightRatio': yandex_h}
-                }
-            }
-            art_url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync'
-            req = urllib.request.Request(
-                art_url,
-                data=json.dumps(art_body).encode('utf-8'),
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Api-Key {yandex_api_key}'
+                    'body': json.dumps({
+                        **cached,
+                        'prompt': cached.get('prompt') or prompt,
+                        'cached': True,
+                        'debug': {'total_sec': round(time.time() - t0, 3), 'provider': image_provider}
+                    })
                 }
-            )
-            if proxy_url:
-                proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-                opener = urllib.request.build_opener(proxy_handler)
-                urllib.request.install_opener(opener)
-            try:
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    op_data = json.loads(resp.read().decode('utf-8'))
-            except urllib.error.HTTPError as e:
-                err_b = e.read().decode('utf-8') if e.fp else ''
+
+        if image_provider == 'yandex':
+            if not os.environ.get('YANDEX_API_KEY') or not os.environ.get('YANDEX_FOLDER_ID'):
                 return {
                     'statusCode': 500,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': f'Yandex ART: {e.code}', 'details': err_b[:400]})
+                    'body': json.dumps({'error': 'YANDEX_API_KEY или YANDEX_FOLDER_ID не настроены'})
                 }
-            op_id = op_data.get('id')
-            if not op_id:
+            # Не ждём генерацию: отдаём handle, клиент опрашивает GET ?operation=...
+            if count > 1:
+                ops = generate_variants(count, lambda i: {'operation': encode_operation(submit_yandex_art(prompt, yandex_w, yandex_h, i), None, output)})
                 return {
-                    'statusCode': 500,
+                    'statusCode': 200 if any('operation' in v for v in ops) else 500,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Yandex ART не вернул id операции', 'details': str(op_data)[:300]})
+                    'body': json.dumps({
+                        'status': 'processing',
+                        'operations': sorted(ops, key=lambda v: v['index']),
+                        'pollAfterSec': next_poll_delay(0),
+                        'prompt': prompt
+                    })
                 }
-            op_url = f'https://operation.api.cloud.yandex.net/operations/{op_id}'
-            op_req_headers = {'Authorization': f'Api-Key {yandex_api_key}'}
-            if proxy_url:
-                proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-                opener = urllib.request.build_opener(proxy_handler)
-                urllib.request.install_opener(opener)
-            max_poll_sec = 180
-            poll_interval = 5
-            t_art_start = time.time()
-            while (time.time() - t_art_start) < max_poll_sec:
-                op_req = urllib.request.Request(op_url, headers=op_req_headers)
-                try:
-                    with urllib.request.urlopen(op_req, timeout=30) as op_resp:
-                        op_result = json.loads(op_resp.read().decode('utf-8'))
-                except urllib.error.HTTPError as e:
-                    return {
-                        'statusCode': 500,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': f'Yandex операция: {e.code}'})
-                    }
-                if op_result.get('done'):
-                    response_data = op_result.get('response') or {}
-                    image_b64_art = response_data.get('image')
-                    if image_b64_art:
-                        image_url_art = f"data:image/png;base64,{image_b64_art}"
-                        total_art = round(time.time() - t0, 1)
-                        return {
-                            'statusCode': 200,
-                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({
-                                'imageUrl': image_url_art,
-                                'prompt': prompt,
-                                'debug': {'total_sec': total_art, 'provider': 'yandex'}
-                            })
-                        }
-                    return {
-                        'statusCode': 500,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'В ответе Yandex ART нет изображения'})
-                    }
-                time.sleep(poll_interval)
+            op_id = submit_yandex_art(prompt, yandex_w, yandex_h)
             return {
-                'statusCode': 500,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Yandex ART: генерация заняла слишком много времени. Попробуйте позже.'})
+                'body': json.dumps({
+                    'status': 'processing',
+                    'operation': encode_operation(op_id, cache_key, output),
+                    'operationId': op_id,
+                    'pollAfterSec': next_poll_delay(0),
+                    'prompt': prompt
+                })
             }
 
         api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
 
         if not api_key:
             return {
@@ -264,32 +868,29 @@ def handler(event: dict, context) -> dict:
             'generationConfig': generation_config,
         }
 
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
+        if count > 1:
+            def make_variant(i: int) -> dict:
+                fields, _ = gemini_image_fields(gemini_url, gemini_request, output)
+                if not fields:
+                    raise Exception('В ответе Gemini нет изображения')
+                return fields
 
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
+            variants = generate_variants(count, make_variant)
+            ok = sum(1 for v in variants if 'error' not in v)
+            print(f'[generate_image] variants ok={ok}/{count} total_sec={round(time.time() - t0, 1)}')
+            return {
+                'statusCode': 200 if ok else 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'variants': variants,
+                    'imageUrl': next((v['imageUrl'] for v in variants if 'imageUrl' in v), None),
+                    'prompt': prompt,
+                    'debug': {'total_sec': round(time.time() - t0, 1), 'count': count, 'ok': ok, 'reference': ref_report}
+                })
+            }
 
-        last_error = None
         t_gemini_start = time.time()
-        for attempt in range(MAX_RETRIES):
-            try:
-                print(f'[generate_image] calling_gemini attempt={attempt + 1}')
-                with urllib.request.urlopen(req, timeout=120) as response:
-                    gemini_response = json.loads(response.read().decode('utf-8'))
-                break
-            except urllib.error.HTTPError as e:
-                last_error = e
-                if e.code in RETRY_CODES and attempt < MAX_RETRIES - 1:
-                    time.sleep(RETRY_DELAY_SEC * (attempt + 1))
-                    continue
-                raise
-
+        image_fields, gemini_response = gemini_image_fields(gemini_url, gemini_request, output, cache_key, prompt)
         gemini_elapsed = round(time.time() - t_gemini_start, 1)
         print(f'[generate_image] gemini_elapsed_sec={gemini_elapsed}')
 
@@ -301,30 +902,7 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'Gemini не вернул результат', 'details': gemini_response})
             }
 
-        content = gemini_response['candidates'][0].get('content') or {}
-        parts = content.get('parts') or []
-        image_b64 = None
-        mime_type = 'image/png'
-
-        for part in parts:
-            # REST может вернуть camelCase (inlineData) или snake_case (inline_data)
-            inline = part.get('inlineData') or part.get('inline_data')
-            if inline:
-                image_b64 = inline.get('data')
-                mime_type = inline.get('mimeType') or inline.get('mime_type') or 'image/png'
-                if image_b64:
-                    break
-
-        if not image_b64:
-            # Показать структуру ответа для отладки (без больших base64)
-            def _peek(obj, depth=0):
-                if depth > 4:
-                    return '...'
-                if isinstance(obj, dict):
-                    return {k: _peek(v, depth + 1) if k != 'data' else '<base64>' for k, v in obj.items()}
-                if isinstance(obj, list):
-                    return [_peek(x, depth + 1) for x in obj[:3]]
-                return type(obj).__name__
+        if not image_fields:
             return {
                 'statusCode': 500,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -334,8 +912,7 @@ def handler(event: dict, context) -> dict:
                 })
             }
 
-        # Фронт ожидает imageUrl — отдаём data URL
-        image_url = f"data:{mime_type};base64,{image_b64}"
+        # Фронт ожидает imageUrl — data URL или presigned URL из S3
         total_elapsed = round(time.time() - t0, 1)
         print(f'[generate_image] returning_response total_sec={total_elapsed} gemini_sec={gemini_elapsed}')
 
@@ -343,34 +920,14 @@ def handler(event: dict, context) -> dict:
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
-                'imageUrl': image_url,
+                **image_fields,
                 'prompt': prompt,
-                'debug': {'total_sec': total_elapsed, 'gemini_sec': gemini_elapsed}
+                'debug': {'total_sec': total_elapsed, 'gemini_sec': gemini_elapsed, 'reference': ref_report}
             })
         }
 
     except urllib.error.HTTPError as e:
-        try:
-            error_body = e.read().decode('utf-8') if e.fp else str(e)
-        except Exception:
-            error_body = str(e)
-        user_message = None
-        if error_body:
-            try:
-                err = json.loads(error_body)
-                if err.get('error', {}).get('status') == 'UNAVAILABLE' or err.get('error', {}).get('code') == 503:
-                    user_message = 'Модель перегружена. Обычно это ненадолго — попробуйте через минуту.'
-                elif err.get('error', {}).get('message'):
-                    user_message = err['error']['message'][:200]
-            except Exception:
-                pass
-        if not user_message:
-            if e.code == 503:
-                user_message = 'Сервис Gemini временно недоступен. Попробуйте через минуту.'
-            elif e.code == 429:
-                user_message = 'Слишком много запросов. Подождите немного и попробуйте снова.'
-            else:
-                user_message = f'Gemini API error: {e.code}'
+        user_message = gemini_error_message(e)
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
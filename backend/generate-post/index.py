@@ -2,9 +2,420 @@ import json
 import os
 import urllib.request
 import urllib.error
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PLATFORMS_MAX_CONCURRENCY = int(os.environ.get('PLATFORMS_MAX_CONCURRENCY', '4'))
+
+# Хеджирование provider='auto': запускаем предпочтительного провайдера, если он не ответил
+# за p-квантиль своей задержки - параллельно второго, берём первый ответ
+HEDGE_PREFERRED = os.environ.get('HEDGE_PREFERRED', 'gemini')
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '0.95'))
+HEDGE_DEFAULT_DELAY_SEC = float(os.environ.get('HEDGE_DEFAULT_DELAY_SEC', '6'))
+HEDGE_MIN_SAMPLES = 20
+# Границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = [0.5, 1, 1.5, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30, 45, 60]
+_latency_hist = {
+    'gemini': [0] * (len(LATENCY_BUCKETS) + 1),
+    'yandex': [0] * (len(LATENCY_BUCKETS) + 1)
+}
+_latency_lock = threading.Lock()
+
+# Потоковый режим (stream: true): воркер пишет накопленный текст в S3 не чаще раза в STREAM_FLUSH_SEC,
+# клиент опрашивает GET ?jobId= и показывает текст по мере появления
+STREAM_FLUSH_SEC = float(os.environ.get('STREAM_FLUSH_SEC', '0.5'))
+
+def build_prompt(platform: str, task: str, tone: str, goal: str, length: str, emojis: str) -> str:
+    '''Промпт поста для одной площадки'''
+    platform_names = {
+        'telegram': 'Telegram',
+        'vk': 'ВКонтакте',
+        'instagram': 'Instagram',
+        'facebook': 'Facebook'
+    }
+    
+    length_desc = {
+        'короткий': 'до 200 символов',
+        'средний': '200-500 символов',
+        'длинный': 'более 500 символов'
+    }
+    
+    emoji_desc = {
+        'нет': 'не использовать эмодзи',
+        'мало': 'использовать 1-2 эмодзи',
+        'баланс': 'использовать 3-5 эмодзи',
+        'много': 'использовать много эмодзи (8-12)'
+    }
+    
+    if tone == 'anya_vibe':
+        tone_instruction = '''Пиши в стиле Ани - учителя английского языка и ИИ. 
+Аня ВЕСЕЛАЯ, ПРОСТАЯ, попадает во всякие нелепые ситуации в жизни и учит английскому языку. 
+Она знает английский в СОВЕРШЕНСТВЕ и часто размышляет о нем, делится интересными фактами о языке, грамматике, произношении.
+ЛЮБИТ ШУТИТЬ и веселиться, пишет легко и непринужденно, как будто болтает с другом.
+Делится забавными историями из практики преподавания и изучения языка.
+
+ВАЖНО:
+- Когда используешь английские слова/фразы, ВСЕГДА пиши перевод в скобках сразу после. Пример: "I'm over the moon (на седьмом небе от счастья)"
+- НЕ пиши о принцах, отношениях, парнях, свиданиях, личной жизни
+- Фокусируйся на английском языке, обучении, забавных ситуациях с изучением языка
+- Тон: живой, энергичный, дружелюбный, с юмором и самоиронией'''
+    else:
+        tone_instruction = f'Тон: {tone}'
+    
+    prompt = f"""Создай пост для {platform_names.get(platform, 'социальной сети')}.
+
+Задача: {task}
+
+Требования:
+- {tone_instruction}
+- Цель поста: {goal}
+- Длина: {length_desc.get(length, '200-500 символов')}
+- Эмодзи: {emoji_desc.get(emojis, 'использовать 3-5 эмодзи')}
+
+Напиши готовый пост для {platform_names.get(platform, '')} канала/группы AnyaGPT. Только текст поста, без пояснений."""
+    
+    return prompt
+
+class GenerationError(Exception):
+    '''Ошибка провайдера: сообщение для error и сырой ответ API для details (как отдавал обработчик)'''
+    def __init__(self, message: str, details: str = None):
+        super().__init__(message)
+        self.details = details
+
+def error_payload(e: Exception) -> dict:
+    '''Тело ответа с ошибкой: error и, если есть, details'''
+    body = {'error': str(e)}
+    if getattr(e, 'details', None) is not None:
+        body['details'] = e.details
+    return body
+
+def generate_yandex(prompt: str, proxy_url: str = None, on_chunk=None) -> str:
+    '''Текст поста от YandexGPT. С on_chunk - потоковый ответ, новые фрагменты уходят в on_chunk.
+    Exception - ошибка API или пустой ответ'''
+    yandex_api_key = os.environ.get('YANDEX_API_KEY')
+    yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
+    yandex_url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+    model_uri = f'gpt://{yandex_folder_id}/yandexgpt/latest'
+    yandex_body = {
+        'modelUri': model_uri,
+        'completionOptions': {'temperature': 0.6, 'maxTokens': 2000, 'stream': on_chunk is not None},
+        'messages': [
+            {'role': 'system', 'text': 'Ты копирайтер. Пиши только готовый текст поста, без пояснений и заголовков.'},
+            {'role': 'user', 'text': prompt}
+        ]
+    }
+    req = urllib.request.Request(
+        yandex_url,
+        data=json.dumps(yandex_body).encode('utf-8'),
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Api-Key {yandex_api_key}'
+        }
+    )
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            if on_chunk is None:
+                yandex_response = json.loads(response.read().decode('utf-8'))
+            else:
+                # Поток - JSON по строке, в каждой накопленный текст целиком
+                yandex_response = {}
+                sent = 0
+                for raw_line in response:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line:
+                        continue
+                    yandex_response = json.loads(line)
+                    alternatives = yandex_response.get('result', {}).get('alternatives') or [{}]
+                    partial = alternatives[0].get('message', {}).get('text') or ''
+                    if len(partial) > sent:
+                        on_chunk(partial[sent:])
+                        sent = len(partial)
+    except urllib.error.HTTPError as e:
+        err_body = e.read().decode('utf-8') if e.fp else ''
+        raise GenerationError(f'Yandex GPT: {e.code}', err_body[:500])
+    result = yandex_response.get('result', {}).get('alternatives')
+    if result and len(result) > 0:
+        alt = result[0]
+        generated_text = (alt.get('message', {}).get('text') or alt.get('text') or '').strip()
+        if generated_text:
+            return generated_text
+    raise GenerationError('Не удалось получить ответ от Yandex GPT', str(yandex_response)[:300])
+
+def generate_gemini(prompt: str, proxy_url: str = None, on_chunk=None) -> str:
+    '''Текст поста от Gemini. С on_chunk - streamGenerateContent (SSE), фрагменты уходят в on_chunk.
+    Exception - ошибка API или пустой ответ'''
+    gemini_api_key = os.environ.get('GEMINI_API_KEY')
+    if on_chunk is None:
+        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_api_key}'
+    else:
+        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse&key={gemini_api_key}'
+    
+    gemini_request = {
+        'contents': [{
+            'parts': [{'text': prompt}]
+        }]
+    }
+    
+    req = urllib.request.Request(
+        gemini_url,
+        data=json.dumps(gemini_request).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    
+    if proxy_url:
+        proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
+        opener = urllib.request.build_opener(proxy_handler)
+        urllib.request.install_opener(opener)
+    
+    pieces = []
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            if on_chunk is None:
+                gemini_response = json.loads(response.read().decode('utf-8'))
+            else:
+                # timeout действует на каждое чтение сокета, а не на весь ответ
+                for raw_line in response:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    chunk = json.loads(line[5:].strip())
+                    for candidate in chunk.get('candidates') or []:
+                        for part in (candidate.get('content') or {}).get('parts') or []:
+                            piece = part.get('text')
+                            if piece:
+                                pieces.append(piece)
+                                on_chunk(piece)
+    except urllib.error.HTTPError as e:
+        error_body = e.read().decode('utf-8') if e.fp else 'Unknown error'
+        raise GenerationError(f'Gemini API error: {e.code}', error_body)
+    
+    if on_chunk is not None:
+        if pieces:
+            return ''.join(pieces)
+        raise Exception('Не удалось получить ответ от Gemini')
+    if 'candidates' in gemini_response and gemini_response['candidates']:
+        return gemini_response['candidates'][0]['content']['parts'][0]['text']
+    raise Exception('Не удалось получить ответ от Gemini')
+
+def provider_config_error(provider: str) -> str:
+    '''Текст ошибки, если для провайдера не заданы ключи, иначе None'''
+    if provider == 'yandex' and (not os.environ.get('YANDEX_API_KEY') or not os.environ.get('YANDEX_FOLDER_ID')):
+        return 'YANDEX_API_KEY или YANDEX_FOLDER_ID не настроены'
+    if provider == 'gemini' and not os.environ.get('GEMINI_API_KEY'):
+        return 'GEMINI_API_KEY не настроен'
+    if provider == 'auto' and provider_config_error('gemini') and provider_config_error('yandex'):
+        return 'Не настроен ни один провайдер'
+    return None
+
+def record_latency(provider: str, elapsed: float):
+    '''Добавляет время успешного ответа провайдера в гистограмму'''
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound), len(LATENCY_BUCKETS))
+    with _latency_lock:
+        _latency_hist[provider][bucket] += 1
+
+def latency_percentile(provider: str, q: float = HEDGE_PERCENTILE) -> float:
+    '''Квантиль задержки провайдера по гистограмме (верхняя граница корзины), None - мало замеров'''
+    with _latency_lock:
+        counts = list(_latency_hist[provider])
+    total = sum(counts)
+    if total < HEDGE_MIN_SAMPLES:
+        return None
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= q * total:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+    return LATENCY_BUCKETS[-1] * 2
+
+def latency_stats() -> dict:
+    '''Число замеров и p50/p95 по провайдерам'''
+    return {
+        provider: {
+            'samples': sum(_latency_hist[provider]),
+            'p50': latency_percentile(provider, 0.5),
+            'p95': latency_percentile(provider, 0.95)
+        }
+        for provider in _latency_hist
+    }
+
+def generate_post(prompt: str, provider: str, proxy_url: str = None) -> str:
+    '''Генерация поста выбранным провайдером ('auto' - с хеджированием)'''
+    if provider == 'auto':
+        return generate_hedged(prompt, proxy_url)[0]
+    t_start = time.time()
+    if provider == 'yandex':
+        text = generate_yandex(prompt, proxy_url)
+    else:
+        text = generate_gemini(prompt, proxy_url)
+    record_latency('yandex' if provider == 'yandex' else 'gemini', time.time() - t_start)
+    return text
+
+def generate_hedged(prompt: str, proxy_url: str = None, preferred: str = None) -> tuple:
+    '''Хеджированный запрос: предпочтительный провайдер, через p95 его задержки - второй.
+    Возвращает (текст, провайдер, был ли запущен второй). Проигравший запрос не ждём'''
+    preferred = preferred if preferred in ('gemini', 'yandex') else HEDGE_PREFERRED
+    backup = 'yandex' if preferred == 'gemini' else 'gemini'
+    if provider_config_error(backup):
+        return generate_post(prompt, preferred, proxy_url), preferred, False
+    if provider_config_error(preferred):
+        return generate_post(prompt, backup, proxy_url), backup, False
+    
+    delay = latency_percentile(preferred) or HEDGE_DEFAULT_DELAY_SEC
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = {pool.submit(generate_post, prompt, preferred, proxy_url): preferred}
+        done, _ = wait(futures, timeout=delay)
+        first = next(iter(done), None)
+        if first and first.exception() is None:
+            return first.result(), preferred, False
+        
+        # Предпочтительный медлит или упал - запускаем второй
+        futures[pool.submit(generate_post, prompt, backup, proxy_url)] = backup
+        pending = set(futures) - done
+        error = first.exception() if first else None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), futures[future], True
+                error = future.exception()
+        raise error
+    finally:
+        pool.shutdown(wait=False)
+
+def generate_for_platforms(platforms: list, request_data: dict, provider: str, proxy_url: str = None) -> tuple:
+    '''Посты для нескольких площадок параллельно: ({площадка: пост}, {площадка: ошибка})'''
+    def run(platform: str) -> str:
+        prompt = build_prompt(
+            platform,
+            request_data.get('task', ''),
+            request_data.get('tone', 'дружелюбный'),
+            request_data.get('goal', 'вовлечение'),
+            request_data.get('length', 'средний'),
+            request_data.get('emojis', 'баланс')
+        )
+        return generate_post(prompt, provider, proxy_url)
+    
+    posts = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=min(PLATFORMS_MAX_CONCURRENCY, len(platforms))) as pool:
+        futures = {platform: pool.submit(run, platform) for platform in platforms}
+        for platform, future in futures.items():
+            try:
+                posts[platform] = future.result()
+            except Exception as e:
+                errors[platform] = str(e)
+    return posts, errors
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
+def _get_s3():
+    '''Клиент S3 создаётся один раз на тёплый контейнер: boto3-клиент потокобезопасен, а его сборка - десятки мс'''
+    global _s3_client
+    bucket = os.environ.get('S3_BUCKET')
+    key_id = os.environ.get('S3_ACCESS_KEY')
+    secret = os.environ.get('S3_SECRET_KEY')
+    if not (bucket and key_id and secret):
+        return None, None
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url='https://storage.yandexcloud.net',
+                    aws_access_key_id=key_id,
+                    aws_secret_access_key=secret,
+                )
+    return _s3_client, bucket
+
+def _write_status(s3, bucket: str, job_id: str, data: dict):
+    s3.put_object(
+        Bucket=bucket,
+        Key=f'posts/jobs/{job_id}/status.json',
+        Body=json.dumps(data, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json',
+    )
+
+def run_stream_job(job_id: str, prompt: str, provider: str, proxy_url: str = None):
+    '''Воркер потокового режима: генерирует пост потоком и сбрасывает накопленный текст в status.json'''
+    s3, bucket = _get_s3()
+    if provider == 'auto':
+        # Хедж для потока не делаем: берём предпочтительного провайдера, если он настроен
+        provider = HEDGE_PREFERRED if not provider_config_error(HEDGE_PREFERRED) else ('yandex' if HEDGE_PREFERRED == 'gemini' else 'gemini')
+    t_start = time.time()
+    pieces = []
+    state = {'flushed_at': 0.0, 'first_token_sec': None}
+    
+    def on_chunk(piece: str):
+        pieces.append(piece)
+        now = time.time()
+        if state['first_token_sec'] is None:
+            state['first_token_sec'] = round(now - t_start, 2)
+        if now - state['flushed_at'] >= STREAM_FLUSH_SEC:
+            state['flushed_at'] = now
+            _write_status(s3, bucket, job_id, {
+                'status': 'streaming',
+                'post': ''.join(pieces),
+                'provider': provider,
+                'firstTokenSec': state['first_token_sec']
+            })
+    
+    try:
+        if provider == 'yandex':
+            text = generate_yandex(prompt, proxy_url, on_chunk)
+        else:
+            text = generate_gemini(prompt, proxy_url, on_chunk)
+        record_latency('yandex' if provider == 'yandex' else 'gemini', time.time() - t_start)
+        _write_status(s3, bucket, job_id, {
+            'status': 'done',
+            'post': text.strip(),
+            'provider': provider,
+            'firstTokenSec': state['first_token_sec'],
+            'elapsedSec': round(time.time() - t_start, 2)
+        })
+    except Exception as e:
+        _write_status(s3, bucket, job_id, {'status': 'error', **error_payload(e), 'post': ''.join(pieces)})
+
+def start_stream_job(prompt: str, provider: str) -> str:
+    '''Сохраняет задачу в S3 и вызывает воркер вторым HTTP-запросом. Возвращает jobId'''
+    import uuid
+    s3, bucket = _get_s3()
+    job_id = uuid.uuid4().hex
+    s3.put_object(
+        Bucket=bucket,
+        Key=f'posts/jobs/{job_id}/input.json',
+        Body=json.dumps({'prompt': prompt, 'provider': provider}, ensure_ascii=False).encode('utf-8'),
+        ContentType='application/json',
+    )
+    _write_status(s3, bucket, job_id, {'status': 'processing', 'post': ''})
+    
+    fn_url = os.environ.get('FUNCTION_URL')
+    if fn_url:
+        try:
+            req = urllib.request.Request(
+                fn_url,
+                data=json.dumps({'_worker': True, 'jobId': job_id}).encode('utf-8'),
+                headers={'Content-Type': 'application/json'},
+                method='POST',
+            )
+            urllib.request.urlopen(req, timeout=3)
+        except Exception as e:
+            print(f'[generate-post] worker trigger: {e}')
+    else:
+        # Самовызов не настроен - генерируем в этом же запросе, клиент получит готовый статус
+        run_stream_job(job_id, prompt, provider, os.environ.get('PROXY_URL'))
+    return job_id
 
 def handler(event: dict, context) -> dict:
-    '''API для генерации постов через Gemini 2.5 Flash с использованием прокси'''
+    '''API для генерации постов через Gemini 2.5 Flash с использованием прокси.
+    stream: true - сразу возвращает jobId, текст появляется по мере генерации в GET ?jobId='''
     
     method = event.get('httpMethod', 'GET')
     
@@ -13,13 +424,50 @@ def handler(event: dict, context) -> dict:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
+    if method == 'GET':
+        # Опрос потокового режима: ?jobId=xxx - накопленный на сейчас текст
+        job_id = (event.get('queryStringParameters') or {}).get('jobId')
+        if not job_id:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Укажите jobId'})
+            }
+        s3, bucket = _get_s3()
+        if not s3:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'S3 не настроен'})
+            }
+        try:
+            r = s3.get_object(Bucket=bucket, Key=f'posts/jobs/{job_id}/status.json')
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': r['Body'].read().decode('utf-8')
+            }
+        except Exception as e:
+            err_str = str(e).lower()
+            if 'nosuchkey' in err_str or '404' in err_str or 'not found' in err_str:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Задача не найдена'})
+                }
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': str(e)})
+            }
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -31,13 +479,32 @@ def handler(event: dict, context) -> dict:
         body_str = event.get('body', '{}')
         request_data = json.loads(body_str)
         
+        if request_data.get('_worker'):
+            job_id = request_data.get('jobId')
+            s3, bucket = _get_s3()
+            if not job_id or not s3:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Нет jobId или не настроен S3'})
+                }
+            r = s3.get_object(Bucket=bucket, Key=f'posts/jobs/{job_id}/input.json')
+            input_data = json.loads(r['Body'].read().decode('utf-8'))
+            run_stream_job(job_id, input_data['prompt'], input_data.get('provider', 'gemini'), os.environ.get('PROXY_URL'))
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'ok': True})
+            }
+        
         platform = request_data.get('platform', 'социальная сеть')
         task = request_data.get('task', '')
         tone = request_data.get('tone', 'дружелюбный')
         goal = request_data.get('goal', 'вовлечение')
         length = request_data.get('length', 'средний')
         emojis = request_data.get('emojis', 'баланс')
-        provider = request_data.get('provider', 'gemini')  # 'gemini' | 'yandex'
+        provider = request_data.get('provider', 'gemini')  # 'gemini' | 'yandex' | 'auto'
+        platforms = request_data.get('platforms')  # список площадок - посты для всех за один запрос
         
         if not task:
             return {
@@ -46,157 +513,65 @@ def handler(event: dict, context) -> dict:
                 'body': json.dumps({'error': 'Задача поста не указана'})
             }
         
-        platform_names = {
-            'telegram': 'Telegram',
-            'vk': 'ВКонтакте',
-            'instagram': 'Instagram',
-            'facebook': 'Facebook'
-        }
-        
-        length_desc = {
-            'короткий': 'до 200 символов',
-            'средний': '200-500 символов',
-            'длинный': 'более 500 символов'
-        }
-        
-        emoji_desc = {
-            'нет': 'не использовать эмодзи',
-            'мало': 'использовать 1-2 эмодзи',
-            'баланс': 'использовать 3-5 эмодзи',
-            'много': 'использовать много эмодзи (8-12)'
-        }
-        
-        if tone == 'anya_vibe':
-            tone_instruction = '''Пиши в стиле Ани - учителя английского языка и ИИ. 
-Аня ВЕСЕЛАЯ, ПРОСТАЯ, попадает во всякие нелепые ситуации в жизни и учит английскому языку. 
-Она знает английский в СОВЕРШЕНСТВЕ и часто размышляет о нем, делится интересными фактами о языке, грамматике, произношении.
-ЛЮБИТ ШУТИТЬ и веселиться, пишет легко и непринужденно, как будто болтает с другом.
-Делится забавными историями из практики преподавания и изучения языка.
-
-ВАЖНО:
-- Когда используешь английские слова/фразы, ВСЕГДА пиши перевод в скобках сразу после. Пример: "I'm over the moon (на седьмом небе от счастья)"
-- НЕ пиши о принцах, отношениях, парнях, свиданиях, личной жизни
-- Фокусируйся на английском языке, обучении, забавных ситуациях с изучением языка
-- Тон: живой, энергичный, дружелюбный, с юмором и самоиронией'''
-        else:
-            tone_instruction = f'Тон: {tone}'
-        
-        prompt = f"""Создай пост для {platform_names.get(platform, 'социальной сети')}.
-
-Задача: {task}
-
-Требования:
-- {tone_instruction}
-- Цель поста: {goal}
-- Длина: {length_desc.get(length, '200-500 символов')}
-- Эмодзи: {emoji_desc.get(emojis, 'использовать 3-5 эмодзи')}
-
-Напиши готовый пост для {platform_names.get(platform, '')} канала/группы AnyaGPT. Только текст поста, без пояснений."""
+        proxy_url = os.environ.get('PROXY_URL')
+        config_error = provider_config_error(provider)
+        if config_error:
+            return {
+                'statusCode': 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': config_error})
+            }
         
-        if provider == 'yandex':
-            yandex_api_key = os.environ.get('YANDEX_API_KEY')
-            yandex_folder_id = os.environ.get('YANDEX_FOLDER_ID')
-            proxy_url = os.environ.get('PROXY_URL')
-            if not yandex_api_key or not yandex_folder_id:
+        if isinstance(platforms, list):
+            platforms = list(dict.fromkeys(p for p in platforms if isinstance(p, str) and p))
+            if not platforms:
                 return {
-                    'statusCode': 500,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'YANDEX_API_KEY или YANDEX_FOLDER_ID не настроены'})
+                    'body': json.dumps({'error': 'Список площадок пуст'})
                 }
-            yandex_url = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
-            model_uri = f'gpt://{yandex_folder_id}/yandexgpt/latest'
-            yandex_body = {
-                'modelUri': model_uri,
-                'completionOptions': {'temperature': 0.6, 'maxTokens': 2000, 'stream': False},
-                'messages': [
-                    {'role': 'system', 'text': 'Ты копирайтер. Пиши только готовый текст поста, без пояснений и заголовков.'},
-                    {'role': 'user', 'text': prompt}
-                ]
+            posts, errors = generate_for_platforms(platforms, request_data, provider, proxy_url)
+            return {
+                'statusCode': 200 if posts else 500,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'posts': posts, 'errors': errors})
             }
-            req = urllib.request.Request(
-                yandex_url,
-                data=json.dumps(yandex_body).encode('utf-8'),
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Api-Key {yandex_api_key}'
-                }
-            )
-            if proxy_url:
-                proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-                opener = urllib.request.build_opener(proxy_handler)
-                urllib.request.install_opener(opener)
-            try:
-                with urllib.request.urlopen(req, timeout=60) as response:
-                    yandex_response = json.loads(response.read().decode('utf-8'))
-            except urllib.error.HTTPError as e:
-                err_body = e.read().decode('utf-8') if e.fp else ''
+        
+        prompt = build_prompt(platform, task, tone, goal, length, emojis)
+        
+        if request_data.get('stream') is True:
+            if not _get_s3()[0]:
                 return {
                     'statusCode': 500,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': f'Yandex GPT: {e.code}', 'details': err_body[:500]})
+                    'body': json.dumps({'error': 'Настройте S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY'})
                 }
-            result = yandex_response.get('result', {}).get('alternatives')
-            if result and len(result) > 0:
-                alt = result[0]
-                generated_text = (alt.get('message', {}).get('text') or alt.get('text') or '').strip()
-                if generated_text:
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'post': generated_text})
-                    }
+            job_id = start_stream_job(prompt, provider)
             return {
-                'statusCode': 500,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Не удалось получить ответ от Yandex GPT', 'details': str(yandex_response)[:300]})
+                'body': json.dumps({'jobId': job_id, 'pollIntervalSec': STREAM_FLUSH_SEC})
             }
         
-        gemini_api_key = os.environ.get('GEMINI_API_KEY')
-        proxy_url = os.environ.get('PROXY_URL')
-        
-        if not gemini_api_key:
+        if provider == 'auto':
+            generated_text, used_provider, hedged = generate_hedged(prompt, proxy_url, request_data.get('preferredProvider'))
             return {
-                'statusCode': 500,
+                'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'GEMINI_API_KEY не настроен'})
+                'body': json.dumps({
+                    'post': generated_text,
+                    'provider': used_provider,
+                    'hedged': hedged,
+                    'latency': latency_stats()
+                })
             }
         
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={gemini_api_key}'
-        
-        gemini_request = {
-            'contents': [{
-                'parts': [{'text': prompt}]
-            }]
+        generated_text = generate_post(prompt, provider, proxy_url)
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'post': generated_text})
         }
-        
-        req = urllib.request.Request(
-            gemini_url,
-            data=json.dumps(gemini_request).encode('utf-8'),
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if proxy_url:
-            proxy_handler = urllib.request.ProxyHandler({'http': proxy_url, 'https': proxy_url})
-            opener = urllib.request.build_opener(proxy_handler)
-            urllib.request.install_opener(opener)
-        
-        with urllib.request.urlopen(req, timeout=30) as response:
-            gemini_response = json.loads(response.read().decode('utf-8'))
-        
-        if 'candidates' in gemini_response and gemini_response['candidates']:
-            generated_text = gemini_response['candidates'][0]['content']['parts'][0]['text']
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'post': generated_text})
-            }
-        else:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Не удалось получить ответ от Gemini'})
-            }
     
     except urllib.error.HTTPError as e:
         error_body = e.read().decode('utf-8') if e.fp else 'Unknown error'
@@ -210,5 +585,5 @@ def handler(event: dict, context) -> dict:
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)})
+            'body': json.dumps(error_payload(e))
         }
\ No newline at end of file
@@ -4,30 +4,120 @@
 """
 
 import base64
+import binascii
+import hashlib
+import io
 import json
 import os
+import threading
 import time
 import urllib.request
+from collections import OrderedDict
 
 VEO_MODEL = 'veo-3.1-generate-preview'
 POLL_INTERVAL = 10
 MAX_POLL_MINUTES = 10
 
+# Предобработка образца перед сохранением в input.json: Veo выдаёт максимум 1080p,
+# больший образец только раздувает задачу. Уменьшаем, убираем EXIF, пережимаем; кэш по sha256 исходника
+REF_MAX_SIDE = int(os.environ.get('REF_MAX_SIDE', '1920'))
+REF_JPEG_QUALITY = 85
+REF_CACHE_SIZE = 32
+_ref_cache = OrderedDict()
+_ref_lock = threading.Lock()
+
+
+_s3_client = None
+_s3_lock = threading.Lock()
+
 
 def _get_s3():
+    '''Клиент S3 создаётся один раз на тёплый контейнер: boto3-клиент потокобезопасен, а его сборка - десятки мс'''
+    global _s3_client
     bucket = os.environ.get('S3_BUCKET')
     key_id = os.environ.get('S3_ACCESS_KEY')
     secret = os.environ.get('S3_SECRET_KEY')
     if not (bucket and key_id and secret):
         return None, None
-    import boto3
-    s3 = boto3.client(
-        's3',
-        endpoint_url='https://storage.yandexcloud.net',
-        aws_access_key_id=key_id,
-        aws_secret_access_key=secret,
-    )
-    return s3, bucket
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url='https://storage.yandexcloud.net',
+                    aws_access_key_id=key_id,
+                    aws_secret_access_key=secret,
+                )
+    return _s3_client, bucket
+
+
+class ReferenceImageError(ValueError):
+    '''Образец не читается: испорченный base64 или не изображение'''
+
+
+# Служебные поля Pillow, которые не несут сведений о съёмке/авторе (EXIF, GPS, XMP, комментарии - несут)
+_REF_PLAIN_INFO = {
+    'dpi', 'jfif', 'jfif_version', 'jfif_unit', 'jfif_density', 'progressive', 'progression',
+    'adobe', 'adobe_transform', 'transparency', 'gamma', 'interlace', 'aspect', 'srgb', 'icc_profile',
+    'duration', 'loop', 'background', 'version', 'compression',
+}
+
+
+def preprocess_reference(ref_b64: str, ref_mime: str) -> tuple:
+    '''Готовит образец к отправке: поворот по EXIF, уменьшение до REF_MAX_SIDE, без метаданных,
+    JPEG (PNG при прозрачности). Результат кэшируется по sha256 исходника.
+    Возвращает (base64, mimeType, отчёт). ReferenceImageError - образец не читается. Без Pillow - исходник как есть'''
+    try:
+        raw = base64.b64decode(ref_b64)
+    except (binascii.Error, ValueError, TypeError):
+        raise ReferenceImageError('Образец изображения повреждён: неверный base64')
+    if not raw:
+        raise ReferenceImageError('Образец изображения пуст')
+    digest = hashlib.sha256(raw).hexdigest()
+    report = {'originalBytes': len(raw), 'bytes': len(raw), 'savedPct': 0, 'cached': False}
+    with _ref_lock:
+        hit = _ref_cache.get(digest)
+        if hit:
+            _ref_cache.move_to_end(digest)
+    if hit:
+        data, mime = hit
+        report.update({'bytes': len(data), 'savedPct': round(100 * (1 - len(data) / len(raw))), 'cached': True})
+        return base64.b64encode(data).decode(), mime, report
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print('[reference] Pillow not installed, sending as is')
+        return ref_b64, ref_mime, report
+    try:
+        img = Image.open(io.BytesIO(raw))
+        img.load()
+    except Exception as e:
+        # UnidentifiedImageError, DecompressionBombError, обрезанный файл
+        print(f'[reference] decode failed: {e}')
+        raise ReferenceImageError('Не удалось прочитать образец изображения')
+    with img:
+        has_metadata = bool(img.getexif()) or any(key not in _REF_PLAIN_INFO for key in img.info)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((REF_MAX_SIDE, REF_MAX_SIDE))
+        out = io.BytesIO()
+        if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+            img.save(out, format='PNG', optimize=True)
+            mime = 'image/png'
+        else:
+            img.convert('RGB').save(out, format='JPEG', quality=REF_JPEG_QUALITY, optimize=True)
+            mime = 'image/jpeg'
+    data = out.getvalue()
+    if len(data) >= len(raw) and not has_metadata:
+        # Уже компактный исходник без метаданных - оставляем как есть.
+        # С метаданными (EXIF, GPS) отправляем перекодированный, даже если он чуть больше
+        data, mime = raw, ref_mime
+    with _ref_lock:
+        _ref_cache[digest] = (data, mime)
+        while len(_ref_cache) > REF_CACHE_SIZE:
+            _ref_cache.popitem(last=False)
+    report.update({'bytes': len(data), 'savedPct': round(100 * (1 - len(data) / len(raw)))})
+    return base64.b64encode(data).decode(), mime, report
 
 
 def _write_status(job_id: str, status: str, video_url: str = None, error: str = None):
@@ -261,11 +351,16 @@ def handler(event: dict, context) -> dict:
         import uuid
         job_id = uuid.uuid4().hex
         input_payload = {'prompt': prompt, 'aspectRatio': aspect_ratio, 'durationSec': duration_sec}
+        ref_report = None
         if reference_image and isinstance(reference_image, dict) and (reference_image.get('data') or reference_image.get('dataBase64')):
-            input_payload['referenceImage'] = {
-                'data': reference_image.get('data') or reference_image.get('dataBase64'),
-                'mimeType': reference_image.get('mimeType') or reference_image.get('mime_type') or 'image/png',
-            }
+            try:
+                ref_data, ref_mime, ref_report = preprocess_reference(
+                    reference_image.get('data') or reference_image.get('dataBase64'),
+                    reference_image.get('mimeType') or reference_image.get('mime_type') or 'image/png',
+                )
+            except ReferenceImageError as e:
+                return {'statusCode': 400, 'headers': headers, 'body': json.dumps({'error': str(e)})}
+            input_payload['referenceImage'] = {'data': ref_data, 'mimeType': ref_mime}
         s3.put_object(
             Bucket=bucket,
             Key=f'veo/jobs/{job_id}/input.json',
@@ -284,7 +379,7 @@ def handler(event: dict, context) -> dict:
             urllib.request.urlopen(req, timeout=3)
         except Exception as e:
             print(f'[generate-video] worker trigger: {e}')
-        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'jobId': job_id})}
+        return {'statusCode': 200, 'headers': headers, 'body': json.dumps({'jobId': job_id, 'reference': ref_report})}
 
     except Exception as e:
         return {'statusCode': 500, 'headers': headers, 'body': json.dumps({'error': str(e)})}
@@ -0,0 +1,2 @@
+-- Индекс для инкрементального get_status: разделы задачи, изменившиеся после курсора
+CREATE INDEX IF NOT EXISTS idx_section_job_updated ON document_sections(job_id, updated_at);
@@ -0,0 +1,8 @@
+-- Кэш структур документов (mode = 'topics'), ключ - sha256 нормализованных входных данных
+CREATE TABLE IF NOT EXISTS outline_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    topics JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_outline_cache_created ON outline_cache(created_at);
@@ -0,0 +1,5 @@
+-- Очередь разделов: какой воркер держит раздел и до какого момента (после истечения раздел забирают заново)
+ALTER TABLE document_sections ADD COLUMN IF NOT EXISTS worker_id VARCHAR(64);
+ALTER TABLE document_sections ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_section_queue ON document_sections(status, lease_expires_at);
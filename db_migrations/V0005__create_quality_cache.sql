@@ -0,0 +1,9 @@
+-- Кэш оценок качества текста (check-content и doc-writer check_quality).
+-- Ключ - sha256 версии промпта и нормализованного текста
+CREATE TABLE IF NOT EXISTS quality_cache (
+    cache_key VARCHAR(64) PRIMARY KEY,
+    result JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_quality_cache_created ON quality_cache(created_at);
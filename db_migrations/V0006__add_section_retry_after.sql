@@ -0,0 +1,2 @@
+-- Повтор упавшего раздела не раньше retry_after (экспоненциальная пауза между попытками)
+ALTER TABLE document_sections ADD COLUMN IF NOT EXISTS retry_after TIMESTAMP;
